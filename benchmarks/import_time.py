@@ -0,0 +1,105 @@
+"""Cold start budget for the redisero CLI
+
+Runs `redisero --version` and `redisero info` in fresh interpreters under
+`python -X importtime` and fails when the best wall time of a command goes
+over the budget or when one of the heavy dependencies gets imported.
+
+    python benchmarks/import_time.py --budget-ms 200 --repeat 5
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from redisero import state
+
+# dependencies only the commands that talk to servers or modules may import
+HEAVY_MODULES = ["redis", "psutil", "pydantic", "requests", "yaml", "rich.console"]
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def _fake_state():
+    server = {
+        "role": "master",
+        "serverId": 1,
+        "port": 10000,
+        "pid": None,
+        "logFile": None,
+        "rdbFile": "/tmp/dump.rdb",
+        "unixSocket": None,
+    }
+    return {
+        "shards": [
+            {
+                "uuid": "0" * 32,
+                "config": {"redisBinaryPath": "redis-server"},
+                "servers": [server],
+                "slots": [[0, 16383]],
+                "portLease": None,
+            }
+        ]
+    }
+
+
+def run_command(args, cwd):
+    """Run redisero once, return (wall seconds, imported modules)"""
+    st = time.perf_counter()
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "redisero"] + args,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    elapsed = time.perf_counter() - st
+    if res.returncode != 0:
+        raise RuntimeError("redisero %s failed" % " ".join(args))
+    modules = set()
+    for line in res.stderr.decode("utf-8", "replace").splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if m:
+            modules.add(m.group(4))
+    return elapsed, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    opts = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        run_dir = os.path.join(cwd, "remstate", state.StateDir.RUN.value)
+        os.makedirs(run_dir)
+        state.save_state(
+            state.state_path(run_dir, state.DEFAULT_CLUSTER), _fake_state()
+        )
+
+        for args in (["--version"], ["info"]):
+            runs = [run_command(args, cwd) for _ in range(opts.repeat)]
+            best = min(elapsed for elapsed, _ in runs) * 1000
+            heavy = sorted(
+                name
+                for name in set().union(*(modules for _, modules in runs))
+                if name in HEAVY_MODULES
+            )
+            ok = best <= opts.budget_ms and not heavy
+            failed = failed or not ok
+            print(
+                "redisero %-10s best %7.1f ms (budget %.0f ms)%s  %s"
+                % (
+                    " ".join(args),
+                    best,
+                    opts.budget_ms,
+                    ", imports " + ", ".join(heavy) if heavy else "",
+                    "ok" if ok else "FAIL",
+                )
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""Cluster start and stop timing across shard counts
+
+Starts and stops a local cluster repeatedly for every shard count, with and
+without replicas, and records how long each phase of ClusterEnv.startEnv and
+stopEnv took. Both stop paths are timed by default: SHUTDOWN NOSAVE and the
+SIGTERM stop that saves the data, as redisero stop does without --nosave.
+Results can be saved as a baseline, and a later run compared against it
+flags phases that got slower with a one sided Welch t-test.
+
+    python benchmarks/lifecycle.py --shards 1,2,4,8,16,32,64 --save baseline.json
+    python benchmarks/lifecycle.py --compare baseline.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from redisero import cluster, schemas
+
+DEFAULT_SHARDS = "1,2,4,8,16,32,64"
+PHASES = ["spawnMasters", "spawnSlaves", "bootstrap", "waitCluster", "stop", "total"]
+STOP_MODES = {"nosave": True, "save": False}
+
+
+def _betacf(a, b, x):
+    """Continued fraction of the regularized incomplete beta function"""
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        for num in (
+            m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+            -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1)),
+        ):
+            d = 1.0 + num * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1.0 + num / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1.0) < 3e-12:
+            break
+    return h
+
+
+def _betainc(a, b, x):
+    if x <= 0.0 or x >= 1.0:
+        return max(0.0, min(1.0, x))
+    front = math.exp(
+        math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+        + a * math.log(x) + b * math.log(1.0 - x)
+    )
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def welch_test(baseline, current):
+    """One sided Welch t-test that current is slower, returns (t, df, p)"""
+    n1, n2 = len(baseline), len(current)
+    v1 = statistics.variance(baseline) / n1
+    v2 = statistics.variance(current) / n2
+    diff = statistics.mean(current) - statistics.mean(baseline)
+    if v1 + v2 == 0:
+        return math.inf if diff > 0 else 0.0, n1 + n2 - 2, 0.0 if diff > 0 else 1.0
+    t = diff / math.sqrt(v1 + v2)
+    df = (v1 + v2) ** 2 / (v1**2 / (n1 - 1) + v2**2 / (n2 - 1))
+    tail = 0.5 * _betainc(df / 2.0, 0.5, df / (df + t * t))
+    return t, df, tail if t > 0 else 1.0 - tail
+
+
+def _redis_version(binary):
+    try:
+        out = subprocess.run([binary, "--version"], capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip()
+
+
+def run_cycle(binary, root, shards, replicas, noSave):
+    """Start and stop one cluster, return the seconds of each phase"""
+    kwargs = schemas.Defaults().getKwargs()
+    kwargs["useSlaves"] = replicas
+    env = cluster.ClusterEnv(
+        remstate=root,
+        shardsCount=shards,
+        redisBinaryPath=binary,
+        outputFilesFormat="%s-lifecycle",
+        verbose=False,
+        randomizePorts=True,
+        **kwargs,
+    )
+    st = time.time()
+    # a failed start already stops the servers it spawned
+    env.startEnv()
+    env.stopEnv(noSave=noSave)
+    phases = dict(env.phaseTimes)
+    phases["total"] = time.time() - st
+    if env.envIsUp:
+        raise RuntimeError("Cluster of %d shards did not stop" % shards)
+    return phases
+
+
+def run_suite(binary, shardCounts, replicaModes, stopModes, repeat, warmup):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="redisero-lifecycle-") as root:
+        for shards in shardCounts:
+            for replicas in replicaModes:
+                for stop in stopModes:
+                    key = "shards=%d,replicas=%s,stop=%s" % (
+                        shards, "yes" if replicas else "no", stop
+                    )
+                    cycle = (binary, root, shards, replicas, STOP_MODES[stop])
+                    for _ in range(warmup):
+                        run_cycle(*cycle)
+                    samples = {phase: [] for phase in PHASES}
+                    for _ in range(repeat):
+                        for phase, seconds in run_cycle(*cycle).items():
+                            samples.setdefault(phase, []).append(round(seconds, 6))
+                    results[key] = samples
+                    print(
+                        "%-36s total mean %8.3f s  stop mean %7.3f s"
+                        % (key, statistics.mean(samples["total"]), statistics.mean(samples["stop"]))
+                    )
+    return results
+
+
+def compare(baseline, current, alpha, minSlowdown):
+    """List the phases that are significantly and noticeably slower"""
+    regressions = []
+    for key, phases in current.items():
+        for phase, samples in phases.items():
+            base = baseline.get(key, {}).get(phase)
+            if not base or len(base) < 2 or len(samples) < 2:
+                continue
+            baseMean = statistics.mean(base)
+            mean = statistics.mean(samples)
+            slowdown = (mean - baseMean) / baseMean if baseMean else 0.0
+            t, df, p = welch_test(base, samples)
+            flagged = p < alpha and slowdown > minSlowdown
+            print(
+                "%-36s %-13s base %8.4f s  now %8.4f s  %+7.1f%%  p=%.4f%s"
+                % (key, phase, baseMean, mean, slowdown * 100, p, "  SLOWER" if flagged else "")
+            )
+            if flagged:
+                regressions.append(
+                    {"run": key, "phase": phase, "slowdown": slowdown, "t": t, "df": df, "p": p}
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", default=DEFAULT_SHARDS)
+    parser.add_argument(
+        "--replicas", choices=["both", "yes", "no"], default="both"
+    )
+    parser.add_argument(
+        "--stop",
+        choices=["both"] + list(STOP_MODES),
+        default="both",
+        help="stop with SHUTDOWN NOSAVE, with the saving SIGTERM stop or time both",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--binary", default=os.environ.get("REDIS_BINARY", "redis-server")
+    )
+    parser.add_argument("--save", metavar="PATH", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="baseline to compare against")
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument(
+        "--min-slowdown",
+        type=float,
+        default=0.05,
+        help="ignore slowdowns below this fraction even when significant",
+    )
+    opts = parser.parse_args()
+    if opts.repeat < 2:
+        parser.error("--repeat must be at least 2 to compare runs")
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+
+    shardCounts = [int(n) for n in opts.shards.split(",") if n.strip()]
+    replicaModes = {"both": [False, True], "yes": [True], "no": [False]}[opts.replicas]
+    stopModes = list(STOP_MODES) if opts.stop == "both" else [opts.stop]
+    results = {
+        "redis": _redis_version(opts.binary),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "repeat": opts.repeat,
+        "runs": run_suite(
+            opts.binary, shardCounts, replicaModes, stopModes, opts.repeat, opts.warmup
+        ),
+    }
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is None:
+        return 0
+    if baseline.get("redis") != results["redis"]:
+        print("baseline redis %s, now %s" % (baseline.get("redis"), results["redis"]))
+    regressions = compare(baseline["runs"], results["runs"], opts.alpha, opts.min_slowdown)
+    print("%d phase(s) slower than the baseline" % len(regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
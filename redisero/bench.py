@@ -0,0 +1,593 @@
+import json
+import multiprocessing
+import random
+import time
+
+import redis
+import redis.crc
+
+from redisero.state import format_slot_ranges
+
+CLUSTER_SLOTS = 16384
+# 2**7 sub-buckets per power of two keeps every recorded value within 0.8%
+HISTOGRAM_SUB_BITS = 7
+WORKLOAD_OPS = ("get", "set", "hset", "zadd")
+SEARCH_QUERY_OPS = ("text", "tag", "range")
+SEARCH_DOC_TYPES = ("hash", "json")
+SEARCH_WORDS = (
+    "amber", "breeze", "cobalt", "delta", "ember", "fjord", "granite", "harbor",
+    "indigo", "juniper", "kelp", "lantern", "meadow", "nebula", "orchid", "pebble",
+    "quartz", "river", "summit", "thistle", "umber", "valley", "willow", "zephyr",
+)
+SEARCH_TAGS = ("red", "green", "blue", "black", "white", "gray", "orange", "purple")
+SEARCH_MAX_PRICE = 1000
+PERCENTILES = (("p50", 50.0), ("p99", 99.0), ("p999", 99.9))
+
+
+class LatencyHistogram:
+    """Log-linear (HDR style) histogram of latencies in microseconds
+
+    Values below 2**(HISTOGRAM_SUB_BITS + 1) get a bucket each, larger ones
+    share a bucket with the values that have the same HISTOGRAM_SUB_BITS bits
+    after the leading one, so the relative error is bounded whatever the
+    magnitude. Buckets are kept sparse, which makes histograms cheap to ship
+    between processes and merge.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = {int(k): v for k, v in (counts or {}).items()}
+
+    @staticmethod
+    def _index(value):
+        if value < 2 << HISTOGRAM_SUB_BITS:
+            return value
+        shift = value.bit_length() - HISTOGRAM_SUB_BITS - 1
+        return (shift << HISTOGRAM_SUB_BITS) + (value >> shift)
+
+    @staticmethod
+    def _value(index):
+        """Highest value that falls into a bucket"""
+        if index < 2 << HISTOGRAM_SUB_BITS:
+            return index
+        shift = (index >> HISTOGRAM_SUB_BITS) - 1
+        mantissa = index - (shift << HISTOGRAM_SUB_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        index = self._index(max(0, int(value)))
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, percent):
+        total = self.total
+        if not total:
+            return 0
+        rank = max(1, -(-total * percent // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self._value(index)
+        return self._value(max(self.counts))
+
+    def mean(self):
+        total = self.total
+        if not total:
+            return 0.0
+        return sum(self._value(i) * c for i, c in self.counts.items()) / total
+
+    def summary(self):
+        summary = {name: self.percentile(p) for name, p in PERCENTILES}
+        summary["mean"] = round(self.mean(), 1)
+        summary["max"] = self._value(max(self.counts)) if self.counts else 0
+        return summary
+
+    def to_dict(self):
+        return {str(index): count for index, count in sorted(self.counts.items())}
+
+
+def parse_workload(spec, ops=WORKLOAD_OPS):
+    """Parse op[:weight],... such as set:1,get:4 into a list of (op, weight)"""
+    workload = []
+    for item in filter(None, spec.split(",")):
+        op, _, weight = item.strip().partition(":")
+        op = op.lower()
+        if op not in ops:
+            raise ValueError(
+                "Unknown workload op %s, expected one of %s" % (op, ", ".join(ops))
+            )
+        workload.append((op, float(weight or 1)))
+    if not workload or sum(w for _, w in workload) <= 0:
+        raise ValueError("Empty workload: %s" % spec)
+    return workload
+
+
+def cluster_targets(state):
+    """Master address, password and slot ranges of every shard of a run state"""
+    targets = []
+    for shard in state["shards"]:
+        master = shard["servers"][0]
+        targets.append(
+            {
+                "port": master["port"],
+                "password": shard["config"].get("password"),
+                "slots": [tuple(r) for r in shard.get("slots") or []],
+            }
+        )
+    return targets
+
+
+def slot_table(targets):
+    """Map every hash slot to the index of the shard that serves it"""
+    table = [None] * CLUSTER_SLOTS
+    for n, target in enumerate(targets):
+        for start, end in target["slots"]:
+            for slot in range(start, end + 1):
+                table[slot] = n
+    if None in table:
+        raise ValueError("The cluster state does not cover every hash slot")
+    return table
+
+
+def shard_keys(table, shardsCount, prefix, count):
+    """Split count keys named prefix:<n> by the shard that owns them"""
+    keys = [[] for _ in range(shardsCount)]
+    for n in range(count):
+        key = "%s:%d" % (prefix, n)
+        keys[table[redis.crc.key_slot(key.encode())]].append(key)
+    return keys
+
+
+def _command(op, key, value, rnd):
+    if op == "get":
+        return ("GET", key)
+    if op == "set":
+        return ("SET", key, value)
+    if op == "hset":
+        return ("HSET", key, "f%d" % rnd.randrange(16), value)
+    return ("ZADD", key, rnd.random(), "m%d" % rnd.randrange(1024))
+
+
+def _connect(config):
+    return [
+        redis.Connection(
+            host=config["host"], port=t["port"], password=t["password"], socket_timeout=10
+        )
+        for t in config["targets"]
+    ]
+
+
+def _drive(conns, nextRequest, rnd):
+    """Send requests until nextRequest returns None, timing each per shard
+
+    nextRequest(rnd) returns the shard index and the commands to pipeline.
+    """
+    histograms = [LatencyHistogram() for _ in conns]
+    done = [0] * len(conns)
+    errors = [0] * len(conns)
+    start = time.perf_counter()
+    while True:
+        request = nextRequest(rnd)
+        if request is None:
+            break
+        shard, commands = request
+        conn = conns[shard]
+        st = time.perf_counter_ns()
+        try:
+            conn.send_packed_command(conn.pack_commands(commands))
+            for _ in commands:
+                try:
+                    conn.read_response()
+                except redis.ResponseError:
+                    errors[shard] += 1
+        except (redis.ConnectionError, redis.TimeoutError):
+            errors[shard] += len(commands)
+            conn.disconnect()
+            continue
+        histograms[shard].record((time.perf_counter_ns() - st) // 1000)
+        done[shard] += len(commands)
+    elapsed = time.perf_counter() - start
+    for conn in conns:
+        conn.disconnect()
+    return {
+        "histograms": [h.to_dict() for h in histograms],
+        "ops": done,
+        "errors": errors,
+        "elapsed": elapsed,
+    }
+
+
+def _budget(config):
+    """Return a check telling whether the worker may send one more request"""
+    requests = config["requests"]
+    if requests is not None:
+        sent = iter(range(requests + 1))
+        return lambda: next(sent) < requests
+    deadline = time.perf_counter() + config["duration"]
+    return lambda: time.perf_counter() < deadline
+
+
+def _worker(config):
+    """Drive one connection per shard until the deadline or request budget"""
+    targets = config["targets"]
+    conns = _connect(config)
+    table = slot_table(targets)
+    keys = {}
+    for op, _ in config["workload"]:
+        prefix = "bench:%s" % ("s" if op in ("get", "set") else op)
+        keys[op] = shard_keys(table, len(targets), prefix, config["keyspace"])
+    # pick shards in proportion to the keys they own
+    shardWeights = {op: [len(k) for k in opKeys] for op, opKeys in keys.items()}
+    shardIds = range(len(targets))
+    ops = [op for op, _ in config["workload"]]
+    weights = [w for _, w in config["workload"]]
+    value = "x" * config["valueSize"]
+    pipeline = config["pipeline"]
+    more = _budget(config)
+
+    def nextRequest(rnd):
+        if not more():
+            return None
+        op = rnd.choices(ops, weights)[0]
+        shardKeys = keys[op]
+        shard = rnd.choices(shardIds, shardWeights[op])[0]
+        return shard, [
+            _command(op, rnd.choice(shardKeys[shard]), value, rnd) for _ in range(pipeline)
+        ]
+
+    return _drive(conns, nextRequest, random.Random(config["seed"]))
+
+
+def _merge_results(results, targets):
+    """Merge worker results into overall and per shard stats"""
+    # workers time their own request loop, leaving process startup out
+    elapsed = max(result["elapsed"] for result in results)
+    shards = []
+    overall = LatencyHistogram()
+    for n, target in enumerate(targets):
+        histogram = LatencyHistogram()
+        for result in results:
+            histogram.merge(LatencyHistogram(result["histograms"][n]))
+        overall.merge(histogram)
+        shard = _stats(
+            histogram,
+            sum(r["ops"][n] for r in results),
+            sum(r["errors"][n] for r in results),
+            elapsed,
+        )
+        shard.update(
+            shard=n + 1, port=target["port"], slots=format_slot_ranges(target["slots"])
+        )
+        shards.append(shard)
+    return {
+        "elapsed": round(elapsed, 3),
+        "overall": _stats(
+            overall,
+            sum(s["ops"] for s in shards),
+            sum(s["errors"] for s in shards),
+            elapsed,
+        ),
+        "shards": shards,
+    }
+
+
+def _run_workers(fn, configs):
+    with multiprocessing.get_context("spawn").Pool(len(configs)) as pool:
+        return pool.map(fn, configs)
+
+
+def _stats(histogram, ops, errors, elapsed):
+    return {
+        "ops": ops,
+        "errors": errors,
+        "throughput": round(ops / elapsed, 1) if elapsed else 0.0,
+        "latency_us": histogram.summary(),
+        "histogram": histogram.to_dict(),
+    }
+
+
+def run_bench(
+    state,
+    workload,
+    workers=4,
+    duration=10.0,
+    requests=None,
+    pipeline=1,
+    keyspace=100000,
+    valueSize=64,
+    host="localhost",
+):
+    """Run a workload against the cluster of a run state from worker processes
+
+    requests, when given, is the number of requests (pipelines) per worker and
+    replaces duration. Latencies are per request, so with pipelining they are
+    the round trip of the whole pipeline.
+    """
+    targets = cluster_targets(state)
+    slot_table(targets)  # fail early on an incomplete state
+    configs = [
+        {
+            "seed": seed,
+            "targets": targets,
+            "host": host,
+            "workload": workload,
+            "duration": duration,
+            "requests": requests,
+            "pipeline": max(1, pipeline),
+            "keyspace": keyspace,
+            "valueSize": valueSize,
+        }
+        for seed in range(workers)
+    ]
+    return {
+        "workload": [{"op": op, "weight": weight} for op, weight in workload],
+        "workers": workers,
+        "pipeline": max(1, pipeline),
+        "keyspace": keyspace,
+        "valueSize": valueSize,
+        **_merge_results(_run_workers(_worker, configs), targets),
+    }
+
+
+def _print_table(results, write, rate="OPS/SEC"):
+    write(
+        "%-8s %6s %12s %8s %9s %9s %9s %9s"
+        % ("SHARD", "PORT", rate, "ERRORS", "P50(us)", "P99(us)", "P999(us)", "MAX(us)")
+    )
+    rows = [(str(s["shard"]), str(s["port"]), s) for s in results["shards"]]
+    rows.append(("all", "", results["overall"]))
+    for label, port, stats in rows:
+        latency = stats["latency_us"]
+        write(
+            "%-8s %6s %12.1f %8d %9d %9d %9d %9d"
+            % (
+                label,
+                port,
+                stats["throughput"],
+                stats["errors"],
+                latency["p50"],
+                latency["p99"],
+                latency["p999"],
+                latency["max"],
+            )
+        )
+
+
+def print_results(results, write=print):
+    """Print a per shard throughput and latency table of run_bench results"""
+    _print_table(results, write)
+
+
+def _document(rnd):
+    return {
+        "title": " ".join(rnd.sample(SEARCH_WORDS, 4)),
+        "tag": rnd.choice(SEARCH_TAGS),
+        "price": rnd.randrange(SEARCH_MAX_PRICE),
+    }
+
+
+def _ingest_command(docType, key, doc):
+    if docType == "json":
+        return ("JSON.SET", key, "$", json.dumps(doc))
+    return ("HSET", key, "title", doc["title"], "tag", doc["tag"], "price", doc["price"])
+
+
+def _ingest_worker(config):
+    """Write this worker's share of the documents in per shard pipelines"""
+    targets = config["targets"]
+    table = slot_table(targets)
+    batches = [[] for _ in targets]
+    for n in range(config["seed"], config["docs"], config["workers"]):
+        key = "%s%d" % (config["prefix"], n)
+        batches[table[redis.crc.key_slot(key.encode())]].append(key)
+    # interleave the shards so all of them ingest at the same time
+    pending = []
+    batch = config["batch"]
+    for start in range(0, max(map(len, batches)), batch):
+        for shard, keys in enumerate(batches):
+            if keys[start : start + batch]:
+                pending.append((shard, keys[start : start + batch]))
+    requests = iter(pending)
+    docType = config["docType"]
+
+    def nextRequest(rnd):
+        request = next(requests, None)
+        if request is None:
+            return None
+        shard, keys = request
+        return shard, [_ingest_command(docType, key, _document(rnd)) for key in keys]
+
+    return _drive(_connect(config), nextRequest, random.Random(config["seed"]))
+
+
+def _query_command(op, index, rnd):
+    if op == "text":
+        query = "@title:%s" % rnd.choice(SEARCH_WORDS)
+    elif op == "tag":
+        query = "@tag:{%s}" % rnd.choice(SEARCH_TAGS)
+    else:
+        low = rnd.randrange(SEARCH_MAX_PRICE)
+        query = "@price:[%d %d]" % (low, low + SEARCH_MAX_PRICE // 10)
+    return ("FT.SEARCH", index, query, "LIMIT", 0, 10)
+
+
+def _query_worker(config):
+    """Run the query mix against every shard in turn until the budget is spent"""
+    shards = len(config["targets"])
+    ops = [op for op, _ in config["queries"]]
+    weights = [w for _, w in config["queries"]]
+    more = _budget(config)
+    turn = iter(range(config["seed"], 1 << 62))
+
+    def nextRequest(rnd):
+        if not more():
+            return None
+        op = rnd.choices(ops, weights)[0]
+        return next(turn) % shards, [_query_command(op, config["index"], rnd)]
+
+    return _drive(_connect(config), nextRequest, random.Random(config["seed"]))
+
+
+def _shard_clients(targets, host):
+    return [
+        redis.Redis(host, t["port"], password=t["password"], decode_responses=True)
+        for t in targets
+    ]
+
+
+def _has_coordinator(client):
+    """Whether the search module runs with its cluster coordinator"""
+    for command in ("SEARCH.CLUSTERREFRESH", "FT.CLUSTERREFRESH"):
+        try:
+            client.execute_command(command)
+            return True
+        except redis.ResponseError as e:
+            if "unknown command" not in str(e).lower():
+                return True
+    return False
+
+
+def create_index(targets, host, docType, index, prefix):
+    """(Re)create the search index, once through a coordinator or on every master"""
+    if docType == "json":
+        schema = ["$.title", "AS", "title", "TEXT", "$.tag", "AS", "tag", "TAG"]
+        schema += ["$.price", "AS", "price", "NUMERIC", "SORTABLE"]
+    else:
+        schema = ["title", "TEXT", "tag", "TAG", "price", "NUMERIC", "SORTABLE"]
+    clients = _shard_clients(targets, host)
+    if _has_coordinator(clients[0]):
+        # the coordinator drops and creates the index on every shard by itself
+        clients = clients[:1]
+    for client in clients:
+        try:
+            client.execute_command("FT.DROPINDEX", index)
+        except redis.ResponseError:
+            pass
+        client.execute_command(
+            "FT.CREATE", index, "ON", docType.upper(), "PREFIX", 1, prefix,
+            "SCHEMA", *schema,
+        )
+
+
+def _require_module(targets, host, module, *probe):
+    for n, client in enumerate(_shard_clients(targets, host), 1):
+        try:
+            client.execute_command(*probe)
+        except redis.ResponseError as e:
+            if "unknown command" in str(e).lower():
+                raise RuntimeError("%s is not loaded on shard %d" % (module, n))
+
+
+def _index_done(client, index):
+    reply = client.execute_command("FT.INFO", index)
+    info = reply if isinstance(reply, dict) else dict(zip(reply[::2], reply[1::2]))
+    return int(info.get("indexing", 0)) == 0 and float(
+        info.get("percent_indexed", 1)
+    ) >= 1
+
+
+def wait_index_built(targets, host, index, timeout=600):
+    """Seconds until every shard finished indexing, per shard"""
+    clients = _shard_clients(targets, host)
+    times = [None] * len(clients)
+    start = time.perf_counter()
+    while None in times:
+        elapsed = time.perf_counter() - start
+        if elapsed > timeout:
+            raise RuntimeError("Index %s not built after %s seconds" % (index, timeout))
+        for n, client in enumerate(clients):
+            if times[n] is None and _index_done(client, index):
+                times[n] = round(elapsed, 3)
+        time.sleep(0.02)
+    return times
+
+
+def run_search_bench(
+    state,
+    docType="hash",
+    docs=100000,
+    workers=4,
+    batch=100,
+    queries=(("text", 1.0), ("tag", 1.0), ("range", 1.0)),
+    duration=10.0,
+    requests=None,
+    index="redisero-idx",
+    indexFirst=False,
+    host="localhost",
+):
+    """Ingest synthetic documents, build a search index and query it
+
+    Documents are hashes or RedisJSON documents written slot-aware, batch per
+    pipeline. The index is created once ingest is done, so the build time is
+    the backfill of all documents, or before ingest with indexFirst, where it
+    is the time indexing lags behind the writes.
+    """
+    if docType not in SEARCH_DOC_TYPES:
+        raise ValueError("Unknown document type: %s" % docType)
+    targets = cluster_targets(state)
+    slot_table(targets)
+    prefix = "redisero:doc:"
+    base = {"targets": targets, "host": host, "workers": workers}
+
+    _require_module(targets, host, "RediSearch", "FT._LIST")
+    if docType == "json":
+        _require_module(targets, host, "RedisJSON", "JSON.TYPE", prefix + "probe")
+    if indexFirst:
+        create_index(targets, host, docType, index, prefix)
+    ingestConfigs = [
+        dict(base, seed=seed, docs=docs, batch=max(1, batch), docType=docType, prefix=prefix)
+        for seed in range(workers)
+    ]
+    ingest = _merge_results(_run_workers(_ingest_worker, ingestConfigs), targets)
+    if not indexFirst:
+        create_index(targets, host, docType, index, prefix)
+    buildTimes = wait_index_built(targets, host, index)
+
+    queryConfigs = [
+        dict(base, seed=seed, queries=list(queries), duration=duration,
+             requests=requests, index=index)
+        for seed in range(workers)
+    ]
+    query = _merge_results(_run_workers(_query_worker, queryConfigs), targets)
+    return {
+        "docType": docType,
+        "docs": docs,
+        "workers": workers,
+        "batch": batch,
+        "index": index,
+        "indexFirst": indexFirst,
+        "modules": state.get("modulePath"),
+        "ingest": ingest,
+        "indexBuild": {
+            "seconds": max(buildTimes),
+            "shards": [
+                {"shard": n + 1, "port": t["port"], "seconds": seconds}
+                for n, (t, seconds) in enumerate(zip(targets, buildTimes))
+            ],
+        },
+        "query": dict(query, mix=[{"op": op, "weight": w} for op, w in queries]),
+    }
+
+
+def print_search_results(results, write=print):
+    """Print ingest, index build and query tables of run_search_bench results"""
+    write("Ingest (%s documents, %s)" % (results["docs"], results["docType"]))
+    _print_table(results["ingest"], write, rate="DOCS/SEC")
+    write("Index build: %.3f seconds" % results["indexBuild"]["seconds"])
+    for shard in results["indexBuild"]["shards"]:
+        write("%-8s %6s %9.3f" % (shard["shard"], shard["port"], shard["seconds"]))
+    write("Queries")
+    _print_table(results["query"], write, rate="QUERIES/SEC")
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
@@ -1,40 +1,62 @@
 import os
-import pickle
-import re
-import subprocess
-from functools import partial
-from typing import Optional
+import shlex
+import sys
+from functools import lru_cache, partial
+from typing import List, Optional
 
 import typer
-from rich.console import Console
 
-from redisero import (__app_name__, __version__, cluster, loader, os_platform,
-                      schemas, utils)
+# heavy dependencies (redis, psutil, rich, pydantic, ...) are imported by the
+# commands that need them, keep this module cheap to import
+from redisero import __app_name__, __version__, state
 
 app = typer.Typer()
-console = Console()
+template_app = typer.Typer(help="Save and start cluster templates.")
+app.add_typer(template_app, name="template")
+
+
+@lru_cache(maxsize=None)
+def _console():
+    from rich.console import Console
+
+    return Console()
+
 
 REDIS_BINARY = os.environ.get("REDIS_BINARY", "redis-server")
 RUN_STATE = "/remstate"
 ROOT_DIR = os.path.abspath(os.getcwd()) + RUN_STATE
-REDIS_RUN_STATE_PATH = f"{ROOT_DIR}/{schemas.StateDir.RUN.value}/cluster_env.pickle"
+RUN_DIR = f"{ROOT_DIR}/{state.StateDir.RUN.value}"
+TEMPLATES_PATH = f"{ROOT_DIR}/{state.StateDir.TPL.value}"
+NAME_OPTION = typer.Option(
+    state.DEFAULT_CLUSTER, help="Name of the cluster, to run several side by side."
+)
+CLUSTER_NAME_OPTION = typer.Option(
+    state.DEFAULT_CLUSTER, help="Name of the cluster to use."
+)
 
 
 @app.command()
 def loadmodules(
     cfg_path: str = typer.Option(
-        f"{ROOT_DIR}/{schemas.StateDir.CFG.value}/modules.yml",
+        f"{ROOT_DIR}/{state.StateDir.CFG.value}/modules.yml",
         help="Path to module requirements fil.",
     ),
     state_dir_path: str = typer.Option(ROOT_DIR, help="Path to redisero state folder."),
+    force: bool = typer.Option(
+        False, help="Download the modules even if they are already installed."
+    ),
+    update: bool = typer.Option(
+        False, help="Resolve the modules again instead of using modules.lock."
+    ),
 ):
+    from redisero import loader, os_platform
+
+    os_platform.current_platform(f"{state_dir_path}/{state.StateDir.BIN.value}")
     ml = loader.ModuleLoader(
         cfg_path=cfg_path,
         state_dir_path=state_dir_path,
     )
-    ml.load_config()
-    ml.download_module_packages()
-    ml.extract_modules()
+    ml.install(force=force, update=update)
 
 
 @app.command()
@@ -42,7 +64,7 @@ def init():
     concat_root_path = partial(os.path.join, ROOT_DIR)
     make_directory = partial(os.makedirs, exist_ok=True)
 
-    for path_items in map(concat_root_path, schemas.StateDir.list()):
+    for path_items in map(concat_root_path, state.StateDir.list()):
         make_directory(path_items)
 
 
@@ -51,90 +73,557 @@ def start(
     shards: int = typer.Option(1, help="Number of shards"),
     with_replicas: bool = typer.Option(0, help="Use slaves"),
     cfg_path: str = typer.Option(
-        f"{ROOT_DIR}/{schemas.StateDir.CFG.value}/modules.yml",
+        f"{ROOT_DIR}/{state.StateDir.CFG.value}/modules.yml",
         help="Path to module requirements file.",
     ),
     state_dir_path: str = typer.Option(ROOT_DIR, help="Path to redisero state folder."),
     verbose: bool = typer.Option(0, help="Verbose mod"),
+    bootstrap: str = typer.Option(
+        "mesh",
+        help="Cluster bootstrap: mesh (every node meets every node) or star (meet through one seed node).",
+    ),
+    slot_weights: Optional[str] = typer.Option(
+        None, help="Comma separated per-shard slot weights, e.g. 1,1,2."
+    ),
+    slot_ranges: Optional[str] = typer.Option(
+        None,
+        help="Explicit per-shard slot ranges, shards separated by semicolons, e.g. 0-99,200-16383;100-199.",
+    ),
+    randomize_ports: bool = typer.Option(
+        False,
+        help="Lease a free block of random ports instead of starting at 10000.",
+    ),
+    unix_socket: bool = typer.Option(
+        False, help="Also expose every shard on a unix socket."
+    ),
+    placement: str = typer.Option(
+        "none",
+        help="Pin shards to cpus: none, core (dedicated cores per server) or numa (one NUMA node per shard).",
+    ),
+    io_threads: Optional[int] = typer.Option(
+        None, help="Number of io-threads of every server."
+    ),
+    profile: Optional[str] = typer.Option(
+        None,
+        help="Server settings profile: throughput, latency, durable or one from profiles.yml next to the modules config.",
+    ),
+    ephemeral: bool = typer.Option(
+        False,
+        help="Keep rdb, aof, log and cluster config files on tmpfs, dropped on stop.",
+    ),
+    name: str = NAME_OPTION,
 ):
-    if os.path.exists(REDIS_RUN_STATE_PATH):
-        console.print(f"Redis cluster already running")
-        return
+    from redisero import cluster
+
+    _check_cluster_name(name)
+    _check_choice("bootstrap", bootstrap, cluster.BOOTSTRAPS)
+    _check_choice("placement", placement, cluster.PLACEMENTS)
+    settings_profile = _load_profile(profile, cfg_path) if profile else None
+    weights, ranges = _check_slots(shards, slot_weights, slot_ranges)
+    with state.cluster_lock(RUN_DIR, name):
+        if os.path.exists(state.state_path(RUN_DIR, name)):
+            _console().print(f"Redis cluster {name} already running")
+            return
+
+        cluster_env = _create_cluster_env(
+            shards,
+            with_replicas,
+            cfg_path,
+            state_dir_path,
+            verbose,
+            name=name,
+            bootstrap=bootstrap,
+            slotWeights=weights,
+            slotRanges=ranges,
+            randomizePorts=randomize_ports or _needs_port_lease(name),
+            unixSocket=unix_socket,
+            placement=placement,
+            ioThreads=io_threads,
+            profile=settings_profile,
+            ephemeral=ephemeral,
+        )
+        _console().print(f"Starting redis cluster {name}")
+        cluster_env.startEnv()
+        _console().print(
+            f"Redis cluster {name} ready in {cluster_env.startupTime:.3f} seconds"
+        )
+        _save_cluster_env(cluster_env, name)
+
+
+def _create_cluster_env(
+    shards, with_replicas, cfg_path, state_dir_path, verbose, name, **cluster_kwargs
+):
+    from redisero import cluster, loader, os_platform, schemas
 
-    modules_dir = ROOT_DIR + "/mod/"
     default_args = schemas.Defaults().getKwargs()
     default_args["useSlaves"] = with_replicas
-    default_args["modulePath"] = []
-    platform  = os_platform.Platform()
+    platform = os_platform.current_platform(
+        f"{state_dir_path}/{state.StateDir.BIN.value}"
+    )
     signature = f"{platform.osnick}-{platform.arch}"
-    pattern = r".*/([a-z]+-(i386|x86_64|arm64v8|armv7l))/.*"
 
     ml = loader.ModuleLoader(
         cfg_path=cfg_path,
         state_dir_path=state_dir_path,
     )
-    ml.load_config()
-    ml.download_module_packages()
-    ml.extract_modules()
-
-    for file_path in utils.list_files(modules_dir):
-        if re.search(pattern, file_path) and signature not in file_path:
-            continue
-        default_args["modulePath"].append(file_path)
-            
-    cluster_env = cluster.ClusterEnv(
+    # parallel starts share the module cache, install it once at a time
+    with state.file_lock(f"{state_dir_path}/{state.StateDir.MOD.value}/.install.lock"):
+        ml.install()
+    default_args["modulePath"], default_args["moduleArgs"] = ml.load_list(signature)
+
+    return cluster.ClusterEnv(
         remstate=ROOT_DIR,
         shardsCount=shards,
         redisBinaryPath=REDIS_BINARY,
         outputFilesFormat="%s-test",
-        randomizePorts=schemas.Defaults.randomize_ports,
         verbose=verbose,
+        # the default cluster keeps the unnamed state layout
+        name=None if name == state.DEFAULT_CLUSTER else name,
+        **cluster_kwargs,
         **default_args,
     )
-    console.print("Starting redis cluster")
-    cluster_env.startEnv()
 
-    with open(
-        f"{ROOT_DIR}/{schemas.StateDir.RUN.value}/cluster_env.pickle", "wb"
-    ) as pfile:
-        pickle.dump(cluster_env, pfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _check_cluster_name(name):
+    if not state.CLUSTER_NAME_PATTERN.match(name):
+        _console().print(f"Invalid cluster name: {name}")
+        raise typer.Exit(1)
+
+
+def _check_choice(option, value, choices):
+    if value not in choices:
+        _console().print(
+            f"Invalid {option}: {value}, expected one of {', '.join(choices)}"
+        )
+        raise typer.Exit(1)
+
+
+def _check_positive(option, value):
+    if value < 1:
+        _console().print(f"Invalid {option}: {value}, expected at least 1")
+        raise typer.Exit(1)
+
+
+def _check_slots(shards, slot_weights, slot_ranges):
+    """Parse the slot options and make sure they allocate every slot"""
+    from redisero import cluster
+
+    try:
+        weights = _parse_slot_weights(slot_weights)
+        ranges = _parse_slot_ranges(slot_ranges)
+        cluster.allocate_slots(shards, weights=weights, ranges=ranges)
+    except ValueError as e:
+        _console().print(f"Invalid slot allocation: {e}")
+        raise typer.Exit(1)
+    return weights, ranges
+
+
+def _load_profile(name, cfg_path):
+    from redisero import schemas
+
+    try:
+        return schemas.load_profile(name, os.path.dirname(cfg_path))
+    except ValueError as e:
+        _console().print(str(e))
+        raise typer.Exit(1)
+
+
+def _needs_port_lease(name):
+    """Named clusters lease random ports, the default one reserves 10000 and up"""
+    return name != state.DEFAULT_CLUSTER
+
+
+def _running_state_path(name):
+    """State file of a running cluster, or None after telling the user"""
+    _check_cluster_name(name)
+    path = state.state_path(RUN_DIR, name)
+    if not os.path.exists(path):
+        _console().print(f"Redis cluster {name} is not running")
+        return None
+    return path
+
+
+def _save_cluster_env(cluster_env, name):
+    state.save_state(state.state_path(RUN_DIR, name), cluster_env.toState())
+
+
+def _load_cluster_env(name):
+    from redisero import cluster
+
+    return cluster.ClusterEnv.fromState(
+        state.load_state(state.state_path(RUN_DIR, name))
+    )
+
+
+def _parse_slot_weights(value):
+    if not value:
+        return None
+    return [float(weight) for weight in value.split(",")]
+
+
+def _parse_slot_ranges(value):
+    if not value:
+        return None
+    ranges = []
+    for shard in value.split(";"):
+        shard_ranges = []
+        for slot_range in filter(None, shard.split(",")):
+            start, _, end = slot_range.partition("-")
+            shard_ranges.append((int(start), int(end or start)))
+        ranges.append(shard_ranges)
+    return ranges
 
 
 @app.command()
-def stop():
-    if not os.path.exists(REDIS_RUN_STATE_PATH):
-        console.print(f"Redis cluster is not running")
+def stop(
+    nosave: bool = typer.Option(
+        False, help="Stop shards with SHUTDOWN NOSAVE, skipping the final save."
+    ),
+    timeout: float = typer.Option(
+        10, help="Seconds to wait for shards to exit before killing them."
+    ),
+    name: str = NAME_OPTION,
+):
+    _check_cluster_name(name)
+    with state.cluster_lock(RUN_DIR, name):
+        state_path = _running_state_path(name)
+        if not state_path:
+            return
+        cluster_env = _load_cluster_env(name)
+        cluster_env.stopEnv(timeout_sec=timeout, noSave=nosave)
+        os.remove(state_path)
+    report = cluster_env.ephemeralReport
+    if report:
+        _console().print(
+            "Ephemeral state dropped, about %s of disk writes avoided "
+            "(%d rdb saves, %d aof rewrites)"
+            % (_format_bytes(report["bytesSaved"]), report["rdbSaves"], report["aofRewrites"])
+        )
+        for path in report["keptLogs"]:
+            _console().print(f"Log of a failed shard kept at: {path}")
+
+
+@app.command()
+def info(name: str = NAME_OPTION):
+    state_path = _running_state_path(name)
+    if not state_path:
         return
-    with open(REDIS_RUN_STATE_PATH, "rb") as handle:
-        cluster_env = pickle.load(handle)
-    cluster_env.stopEnv()
-    os.remove(REDIS_RUN_STATE_PATH)
+    state.print_state(state.load_state(state_path))
+
+
+@app.command("list")
+def list_clusters():
+    clusters = state.list_clusters(RUN_DIR)
+    if not clusters:
+        _console().print("No redis clusters running")
+        return
+    print("%-20s %6s %8s %7s  %s" % ("NAME", "SHARDS", "REPLICAS", "ALIVE", "PORTS"))
+    for name, cluster_state in clusters:
+        servers = [
+            server for shard in cluster_state["shards"] for server in shard["servers"]
+        ]
+        alive = sum(state.pid_alive(server["pid"]) for server in servers)
+        ports = [shard["servers"][0]["port"] for shard in cluster_state["shards"]]
+        print(
+            "%-20s %6d %8s %7s  %s"
+            % (
+                name,
+                len(ports),
+                "yes" if cluster_state.get("useSlaves") else "no",
+                "%d/%d" % (alive, len(servers)),
+                ",".join(map(str, ports)),
+            )
+        )
 
 
 @app.command()
-def info():
-    if not os.path.exists(REDIS_RUN_STATE_PATH):
-        console.print(f"Redis cluster is not running")
+def cli(
+    sh: str = typer.Argument(..., help="Server id of the shard master."),
+    cmd: Optional[List[str]] = typer.Argument(None, help="Command to run."),
+    file: Optional[str] = typer.Option(
+        None,
+        "--file",
+        "-f",
+        help="Read commands, one per line, from a file (- for stdin) and send them as one pipeline.",
+    ),
+    cluster_mode: bool = typer.Option(
+        True,
+        "--cluster/--no-cluster",
+        help="Follow MOVED redirects of keyed commands, like redis-cli -c.",
+    ),
+    resp3: bool = typer.Option(False, help="Talk RESP3 to the server."),
+    unix: bool = typer.Option(
+        False, help="Connect to the shard through its unix socket."
+    ),
+    name: str = NAME_OPTION,
+):
+    if not _running_state_path(name):
         return
-    with open(REDIS_RUN_STATE_PATH, "rb") as handle:
-        cluster_env = pickle.load(handle)
-    cluster_env.printEnvData()
+    cluster_env = _load_cluster_env(name)
+    shard = next(
+        (s for s in cluster_env.shards if str(s.masterServerId) == str(sh)), None
+    )
+    if shard is None:
+        _console().print(f"Shard {sh} not found")
+        raise typer.Exit(1)
+
+    commands = []
+    if cmd:
+        # a single quoted argument holds a whole command line
+        commands.append(shlex.split(cmd[0]) if len(cmd) == 1 else cmd)
+    if file:
+        try:
+            stream = sys.stdin if file == "-" else open(file)
+        except OSError as e:
+            _console().print(f"Cannot read commands from {file}: {e.strerror}")
+            raise typer.Exit(1)
+        with stream:
+            commands += [
+                shlex.split(line)
+                for line in stream
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+    if not commands:
+        _console().print("No commands to run")
+        raise typer.Exit(1)
+
+    # keyless commands run on the chosen shard, keyed ones follow MOVED
+    try:
+        client = shard.getClient(unix=unix, resp3=resp3)
+    except ValueError as e:
+        _console().print(str(e))
+        raise typer.Exit(1)
+    pipe = client.pipeline(transaction=False)
+    for args in commands:
+        pipe.execute_command(*args)
+    redirects = {}
+    for args, reply in zip(commands, pipe.execute(raise_on_error=False)):
+        if cluster_mode:
+            reply = _follow_moved(shard, args, reply, redirects, resp3)
+        print(_format_reply(reply))
+
+
+def _follow_moved(shard, args, reply, redirects, resp3, limit=5):
+    """Re-run a command on the node its MOVED reply points to"""
+    import redis
+
+    for _ in range(limit):
+        if not isinstance(reply, redis.exceptions.MovedError):
+            break
+        address = (reply.host, reply.port)
+        if address not in redirects:
+            redirects[address] = redis.Redis(
+                reply.host,
+                reply.port,
+                password=shard.getPassword(),
+                decode_responses=True,
+                protocol=3 if resp3 else 2,
+            )
+        try:
+            reply = redirects[address].execute_command(*args)
+        except redis.ResponseError as e:
+            reply = e
+    return reply
 
 
 @app.command()
-def cli(sh, cmd):
-    if not os.path.exists(REDIS_RUN_STATE_PATH):
-        console.print(f"Redis cluster is not running")
+def bench(
+    name: str = NAME_OPTION,
+    workload: str = typer.Option(
+        "set:1,get:1",
+        help="Comma separated ops with optional weights, from get, set, hset and zadd.",
+    ),
+    workers: int = typer.Option(4, help="Number of load generating processes."),
+    duration: float = typer.Option(10, help="Seconds to run the workload for."),
+    requests: Optional[int] = typer.Option(
+        None, help="Requests per worker, replacing the duration."
+    ),
+    pipeline: int = typer.Option(1, help="Commands sent per request."),
+    keyspace: int = typer.Option(100000, help="Number of distinct keys per op."),
+    value_size: int = typer.Option(64, help="Size of the written values in bytes."),
+    json_path: Optional[str] = typer.Option(
+        None, "--json", help="Write the results, histograms included, to a JSON file."
+    ),
+):
+    _check_positive("workers", workers)
+    state_path = _running_state_path(name)
+    if not state_path:
         return
-    with open(REDIS_RUN_STATE_PATH, "rb") as handle:
-        cluster_env = pickle.load(handle)
-    for shard in cluster_env.shards:
-        if str(shard.masterServerId) == str(sh):
-            command = ["redis-cli", "-c", "-p", str(shard.port), cmd]
-            command_output = subprocess.Popen(
-                command, stdout=subprocess.PIPE
-            ).communicate()[0]
-            print(command_output)
+
+    from redisero import bench as redisero_bench
+
+    try:
+        parsed_workload = redisero_bench.parse_workload(workload)
+    except ValueError as e:
+        _console().print(str(e))
+        raise typer.Exit(1)
+    _console().print(
+        f"Running {workload} on cluster {name} with {workers} workers"
+    )
+    results = redisero_bench.run_bench(
+        state.load_state(state_path),
+        parsed_workload,
+        workers=workers,
+        duration=duration,
+        requests=requests,
+        pipeline=pipeline,
+        keyspace=keyspace,
+        valueSize=value_size,
+    )
+    results["cluster"] = name
+    redisero_bench.print_results(results)
+    if json_path:
+        redisero_bench.save_results(json_path, results)
+
+
+@app.command("bench-search")
+def bench_search(
+    name: str = NAME_OPTION,
+    doc_type: str = typer.Option("hash", help="Document type, hash or json."),
+    docs: int = typer.Option(100000, help="Number of documents to ingest."),
+    workers: int = typer.Option(4, help="Number of load generating processes."),
+    batch: int = typer.Option(100, help="Documents written per pipeline."),
+    queries: str = typer.Option(
+        "text:1,tag:1,range:1",
+        help="Comma separated query types with optional weights, from text, tag and range.",
+    ),
+    duration: float = typer.Option(10, help="Seconds to run the queries for."),
+    requests: Optional[int] = typer.Option(
+        None, help="Queries per worker, replacing the duration."
+    ),
+    index: str = typer.Option("redisero-idx", help="Name of the search index."),
+    index_first: bool = typer.Option(
+        False, help="Create the index before ingest instead of backfilling it."
+    ),
+    json_path: Optional[str] = typer.Option(
+        None, "--json", help="Write the results, histograms included, to a JSON file."
+    ),
+):
+    _check_positive("workers", workers)
+    state_path = _running_state_path(name)
+    if not state_path:
+        return
+
+    from redisero import bench as redisero_bench
+
+    try:
+        parsed_queries = redisero_bench.parse_workload(
+            queries, redisero_bench.SEARCH_QUERY_OPS
+        )
+        if doc_type not in redisero_bench.SEARCH_DOC_TYPES:
+            raise ValueError(f"Unknown document type {doc_type}, expected hash or json")
+    except ValueError as e:
+        _console().print(str(e))
+        raise typer.Exit(1)
+    _console().print(
+        f"Ingesting {docs} {doc_type} documents on cluster {name} with {workers} workers"
+    )
+    try:
+        results = redisero_bench.run_search_bench(
+            state.load_state(state_path),
+            docType=doc_type,
+            docs=docs,
+            workers=workers,
+            batch=batch,
+            queries=parsed_queries,
+            duration=duration,
+            requests=requests,
+            index=index,
+            indexFirst=index_first,
+        )
+    except RuntimeError as e:
+        _console().print(f"[red]{e}[/red]")
+        raise typer.Exit(1)
+    results["cluster"] = name
+    redisero_bench.print_search_results(results)
+    if json_path:
+        redisero_bench.save_results(json_path, results)
+
+
+def _format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+
+def _format_reply(reply, indent=""):
+    if isinstance(reply, Exception):
+        # redis-py strips the error code, MOVED or ERR, from the message
+        code = getattr(reply, "status_code", None)
+        return f"(error) {code} {reply}" if code else f"(error) {reply}"
+    if reply is None:
+        return "(nil)"
+    if isinstance(reply, bool):
+        return "OK" if reply else "(integer) 0"
+    if isinstance(reply, int):
+        return f"(integer) {reply}"
+    if isinstance(reply, dict):
+        reply = [item for pair in reply.items() for item in pair]
+    if isinstance(reply, (list, tuple, set)):
+        if not reply:
+            return "(empty array)"
+        return "\n".join(
+            f"{indent}{n}) " + _format_reply(item, indent + "   ").lstrip()
+            for n, item in enumerate(reply, 1)
+        )
+    return str(reply)
+
+
+@template_app.command("save")
+def template_save(
+    name: str,
+    with_data: bool = typer.Option(False, help="Also snapshot the shards data."),
+    cluster_name: str = CLUSTER_NAME_OPTION,
+):
+    if not _running_state_path(cluster_name):
+        return
+    cluster_env = _load_cluster_env(cluster_name)
+    cluster_env.saveTemplate(f"{TEMPLATES_PATH}/{name}", withData=with_data)
+    _console().print(f"Cluster template <[cyan]{name}[/cyan]> saved")
+
+
+@template_app.command("start")
+def template_start(
+    name: str,
+    cfg_path: str = typer.Option(
+        f"{ROOT_DIR}/{state.StateDir.CFG.value}/modules.yml",
+        help="Path to module requirements file.",
+    ),
+    state_dir_path: str = typer.Option(ROOT_DIR, help="Path to redisero state folder."),
+    verbose: bool = typer.Option(False, help="Verbose mod"),
+    cluster_name: str = CLUSTER_NAME_OPTION,
+):
+    _check_cluster_name(cluster_name)
+    template_path = f"{TEMPLATES_PATH}/{name}"
+    if not os.path.exists(template_path):
+        _console().print(f"Cluster template <[cyan]{name}[/cyan]> not found")
+        raise typer.Exit(1)
+
+    from redisero import cluster
+
+    with state.cluster_lock(RUN_DIR, cluster_name):
+        if os.path.exists(state.state_path(RUN_DIR, cluster_name)):
+            _console().print(f"Redis cluster {cluster_name} already running")
+            return
+        manifest = cluster.ClusterEnv.readTemplate(template_path)
+        cluster_env = _create_cluster_env(
+            manifest["shardsCount"],
+            manifest["useSlaves"],
+            cfg_path,
+            state_dir_path,
+            verbose,
+            cluster_name,
+            ports=manifest["ports"],
+        )
+        cluster_env.loadTemplate(template_path)
+        _console().print(f"Starting redis cluster from template <[cyan]{name}[/cyan]>")
+        cluster_env.startEnv()
+        message = f"Redis cluster ready in {cluster_env.startupTime:.3f} seconds"
+        if manifest["coldStartTime"] is not None:
+            message += f" (cold bootstrap: {manifest['coldStartTime']:.3f} seconds)"
+        _console().print(message)
+        _save_cluster_env(cluster_env, cluster_name)
 
 
 def _version_callback(value: bool) -> None:
@@ -1,26 +1,206 @@
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import psutil
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 from rich.console import Console
 
-from redisero.utils import (fix_modules, fix_modulesArgs, get_random_port,
-                            wait_for_conn)
+from redisero.state import format_cpu_list, write_file_atomic
+from redisero.utils import (analyse_server_log, binary_supports,
+                            bind_port_lease, cpu_topology, dir_size,
+                            ephemeral_root, fix_modules, fix_modulesArgs,
+                            lease_ports, probe_redis_binary, release_ports,
+                            reserve_ports,
+                            set_process_affinity, wait_for_conn,
+                            wait_for_server)
 
 MASTER = "master"
 SLAVE = "slave"
+BOOTSTRAP_MESH = "mesh"
+BOOTSTRAP_STAR = "star"
+BOOTSTRAPS = (BOOTSTRAP_MESH, BOOTSTRAP_STAR)
+CLUSTER_SLOTS = 16384
+TEMPLATE_MANIFEST = "template.json"
+TEMPLATE_VERSION = 1
+PLACEMENT_NONE = "none"
+PLACEMENT_CORE = "core"
+PLACEMENT_NUMA = "numa"
+PLACEMENTS = (PLACEMENT_NONE, PLACEMENT_CORE, PLACEMENT_NUMA)
 console = Console()
 
 
+def allocate_slots(shardsCount, weights=None, ranges=None):
+    """Split the cluster hash slots between shards
+
+    Returns a list of inclusive (start, end) slot ranges per shard. Slots are
+    spread evenly unless per-shard weights or explicit ranges are given; the
+    result always covers every slot exactly once.
+    """
+    if ranges is not None:
+        if len(ranges) != shardsCount:
+            raise ValueError(
+                "Got slot ranges for %d shards, expected %d" % (len(ranges), shardsCount)
+            )
+        allocation = [sorted((int(s), int(e)) for s, e in shard) for shard in ranges]
+    else:
+        weights = weights or [1] * shardsCount
+        if len(weights) != shardsCount:
+            raise ValueError(
+                "Got slot weights for %d shards, expected %d"
+                % (len(weights), shardsCount)
+            )
+        if any(w < 0 for w in weights) or sum(weights) <= 0:
+            raise ValueError("Slot weights must be non negative with a positive sum")
+        # largest remainder method so the shares add up to exactly CLUSTER_SLOTS
+        total = sum(weights)
+        quotas = [CLUSTER_SLOTS * w / total for w in weights]
+        counts = [int(q) for q in quotas]
+        remainders = sorted(
+            range(shardsCount), key=lambda i: quotas[i] - counts[i], reverse=True
+        )
+        for i in remainders[: CLUSTER_SLOTS - sum(counts)]:
+            counts[i] += 1
+        allocation = []
+        start = 0
+        for count in counts:
+            allocation.append([(start, start + count - 1)] if count else [])
+            start += count
+    check_slot_coverage(allocation)
+    return allocation
+
+
+def check_slot_coverage(allocation):
+    """Raise ValueError unless the slot ranges cover every slot exactly once"""
+    covered = bytearray(CLUSTER_SLOTS)
+    for ranges in allocation:
+        for start, end in ranges:
+            if not 0 <= start <= end < CLUSTER_SLOTS:
+                raise ValueError("Invalid slot range %d-%d" % (start, end))
+            if any(covered[start : end + 1]):
+                raise ValueError("Slot range %d-%d overlaps another shard" % (start, end))
+            covered[start : end + 1] = b"\x01" * (end - start + 1)
+    missing = covered.count(0)
+    if missing:
+        raise ValueError("%d slots are not assigned to any shard" % missing)
+
+
+def merge_slot_ranges(ranges):
+    """Sort slot ranges and merge adjacent ones"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and merged[-1][1] + 1 >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def port_blocks(ports, count):
+    """Merge the count ports starting at every port into consecutive (first, count) blocks"""
+    blocks = []
+    for port in sorted(ports):
+        if blocks and blocks[-1][0] + blocks[-1][1] >= port:
+            blocks[-1][1] = max(blocks[-1][1], port + count - blocks[-1][0])
+        else:
+            blocks.append([port, count])
+    return [tuple(block) for block in blocks]
+
+
+def plan_cpu_placement(
+    placement, shardsCount, serversPerShard, cpusPerServer=1, topology=None
+):
+    """Pick the NUMA node and cpus every server of every shard is pinned to
+
+    Returns one {"node", "cpus"} entry per shard, cpus holding a cpu list per
+    server (master first), or None when placement is PLACEMENT_NONE. Shards
+    are spread round robin over the NUMA nodes and a shard's replica stays on
+    its master's node. PLACEMENT_NUMA pins a shard to its whole node while
+    PLACEMENT_CORE gives every server its own cpusPerServer cores, sharing
+    cores only once a node runs out of them.
+    """
+    if placement not in PLACEMENTS:
+        raise ValueError("Unknown cpu placement: %s" % placement)
+    if placement == PLACEMENT_NONE:
+        return None
+    nodes = topology or cpu_topology()
+    cursors = [0] * len(nodes)
+    plan = []
+    for n in range(shardsCount):
+        node = n % len(nodes)
+        cpus = nodes[node]
+        if placement == PLACEMENT_NUMA:
+            plan.append({"node": node, "cpus": [list(cpus)] * serversPerShard})
+            continue
+        shard_cpus = []
+        for _ in range(serversPerShard):
+            shard_cpus.append(
+                sorted(
+                    {cpus[(cursors[node] + i) % len(cpus)] for i in range(cpusPerServer)}
+                )
+            )
+            cursors[node] += cpusPerServer
+        plan.append({"node": node, "cpus": shard_cpus})
+    return plan
+
+
+def wait_for_stop(stopping, timeout_sec=10):
+    """Wait for signalled servers to exit, SIGKILL whatever outlives the deadline
+
+    stopping is a list of (env, role, processes) as returned by _signalStop.
+    """
+    procs = [p for _, _, role_procs in stopping for p in role_procs]
+    _, alive = psutil.wait_procs(procs, timeout=timeout_sec)
+    for p in alive:
+        console.print("[yellow]Process %d did not stop in time, killing it[/yellow]" % p.pid)
+        for env, role, role_procs in stopping:
+            if p in role_procs:
+                env.failedRoles.add(role)
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(alive, timeout=3)
+    for env, role, role_procs in stopping:
+        env._reapStopped(role, role_procs)
+        env._markStopped(role)
+
+
 class StandardEnv(object):
-    def __init__(
+    def __init__(self, redisBinaryPath, port=6379, **kwargs):
+        self._setFields(redisBinaryPath, **kwargs)
+
+        if port > 0:
+            self.port = port
+            self.slavePort = port + 1 if self.useSlaves else 0
+        elif port == 0:
+            self.portLease = self.uuid
+            ports = lease_ports(2 if self.useSlaves else 1, self.portLease)
+            self.port = ports[0]
+            self.slavePort = ports[1] if self.useSlaves else 0
+        else:
+            self.port = -1
+            self.slavePort = -1
+
+        if self.useUnix:
+            if self.clusterEnabled:
+                raise ValueError("Unix sockets cannot be used with cluster mode")
+            self.port = -1
+
+        if self.has_interactive_debugger and self.masterServerId > 1:
+            assert self.noCatch and not self.useSlaves and not self.clusterEnabled
+
+    def _setFields(
         self,
         redisBinaryPath,
-        port=6379,
         remstate=None,
         modulePath=None,
         moduleArgs=None,
@@ -39,12 +219,40 @@ class StandardEnv(object):
         noCatch=False,
         noLog=False,
         unix=False,
+        unixSocket=False,
         verbose=False,
         clusterNodeTimeout=None,
         tlsPassphrase=None,
         enableDebugCommand=False,
+        envUuid=None,
+        name=None,
+        ioThreads=None,
+        cpuAffinity=None,
+        numaNode=None,
+        profile=None,
+        ephemeralDir=None,
     ):
-        self.uuid = uuid.uuid4().hex
+        """Set up everything but the ports, shared by __init__ and fromState"""
+        self.uuid = envUuid or uuid.uuid4().hex
+        self.name = name
+        self.ioThreads = ioThreads
+        # role -> cpus the server is pinned to
+        self.cpuAffinity = cpuAffinity
+        self.numaNode = numaNode
+        # RAM backed root of the log, rdb and cluster config files, if any
+        self.ephemeralDir = ephemeralDir
+        self.failedRoles = set()
+        # {"name", "settings"} as returned by schemas.load_profile
+        self.profile = profile
+        self.profileSettings = dict(profile["settings"]) if profile else {}
+        # {"settings", "skipped"} once the profile was checked against the binary
+        self.appliedProfile = None
+        # append only files need per server names, leave them to useAof
+        if self.profileSettings.pop("appendonly", None) == "yes":
+            useAof = True
+        profileIoThreads = self.profileSettings.pop("io-threads", None)
+        if ioThreads is None and profileIoThreads:
+            self.ioThreads = int(profileIoThreads)
         self.redisBinaryPath = (
             os.path.expanduser(redisBinaryPath)
             if redisBinaryPath.startswith("~/")
@@ -68,7 +276,8 @@ class StandardEnv(object):
         self.noLog = noLog
         self.environ = os.environ.copy()
         self.useUnix = unix
-        self.dbDirPath = dbDirPath or self.remstate + "/rdb"
+        self.exposeUnixSocket = unixSocket
+        self.dbDirPath = dbDirPath or self._getStateDirPath("rdb")
         self.masterProcess = None
         self.masterExitCode = None
         self.slaveProcess = None
@@ -80,24 +289,7 @@ class StandardEnv(object):
         self.enableDebugCommand = enableDebugCommand
         self.terminateRetries = None
         self.terminateRetrySecs = None
-
-        if port > 0:
-            self.port = port
-            self.slavePort = port + 1 if self.useSlaves else 0
-        elif port == 0:
-            self.port = get_random_port()
-            self.slavePort = get_random_port() if self.useSlaves else 0
-        else:
-            self.port = -1
-            self.slavePort = -1
-
-        if self.useUnix:
-            if self.clusterEnabled:
-                raise ValueError("Unix sockets cannot be used with cluster mode")
-            self.port = -1
-
-        if self.has_interactive_debugger and serverId > 1:
-            assert self.noCatch and not self.useSlaves and not self.clusterEnabled
+        self.portLease = None
 
         if libPath:
             self.libPath = (
@@ -113,11 +305,11 @@ class StandardEnv(object):
             else:
                 self.environ["LD_LIBRARY_PATH"] = self.libPath
 
-        self.masterCmdArgs = self.createCmdArgs(MASTER)
+        # command lines are built on first use, building them probes the binary
+        self._cmdArgs = {}
         self.masterOSEnv = self.createCmdOSEnv(MASTER)
         if self.useSlaves:
             self.slaveServerId = serverId + 1
-            self.slaveCmdArgs = self.createCmdArgs(SLAVE)
             self.slaveOSEnv = self.createCmdOSEnv(SLAVE)
 
         self.envIsHealthy = True
@@ -129,6 +321,34 @@ class StandardEnv(object):
             else "slave-%d" % self.slaveServerId
         )
 
+    def _getStateDirPath(self, kind, persistent=False):
+        # named envs keep their files apart, e.g. remstate/log/<name>
+        root = self.remstate if persistent else self.ephemeralDir or self.remstate
+        path = os.path.join(root, kind)
+        return os.path.join(path, self.name) if self.name else path
+
+    def _makeStateDirs(self):
+        paths = [self.dbDirPath]
+        if self._getLogFilePath(MASTER):
+            paths.append(self._getStateDirPath("log"))
+        if self.clusterEnabled:
+            paths.append(self._getStateDirPath("cfg"))
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+
+    def _getLogFilePath(self, role):
+        if self.noLog or self.noCatch or self.outputFilesFormat is None:
+            return None
+        return os.path.join(self._getStateDirPath("log"), self._getFileName(role, ".log"))
+
+    def _getClusterConfigPath(self, role):
+        return os.path.join(
+            self._getStateDirPath("cfg"), self._getFileName(role, ".cluster.conf")
+        )
+
+    def _getRdbFilePath(self, role):
+        return os.path.join(self.dbDirPath, self._getFileName(role, ".rdb"))
+
     def _getValgrindFilePath(self, role):
         return os.path.join(self.dbDirPath, self._getFileName(role, ".valgrind.log"))
 
@@ -146,22 +366,20 @@ class StandardEnv(object):
     def has_interactive_debugger(self):
         return self.debugger and self.debugger.is_interactive
 
+    def _probeBinary(self):
+        # one probe per binary, shared by all shards and persisted for later runs
+        return probe_redis_binary(
+            self.redisBinaryPath,
+            cacheDir=self.remstate + "/bin" if self.remstate else None,
+        )
+
     def _getRedisVersion(self):
-        options = {
-            "stderr": subprocess.PIPE,
-            "stdin": subprocess.PIPE,
-            "stdout": subprocess.PIPE,
-        }
-        p = subprocess.Popen(args=[self.redisBinaryPath, "--version"], **options)
-        while p.poll() is None:
-            time.sleep(0.1)
-        exit_code = p.poll()
-        if exit_code != 0:
-            raise Exception("Could not extract Redis version")
-        out, err = p.communicate()
-        out = out.decode("utf-8")
-        v = out[out.find("v=") + 2 : out.find("sha=") - 1].split(".")
-        return int(v[0]) * 10000 + int(v[1]) * 100 + int(v[2])
+        return self._probeBinary()["version"]
+
+    def getCmdArgs(self, role):
+        if role not in self._cmdArgs:
+            self._cmdArgs[role] = self.createCmdArgs(role)
+        return self._cmdArgs[role]
 
     def createCmdArgs(self, role):
         cmdArgs = []
@@ -174,6 +392,9 @@ class StandardEnv(object):
 
         if self.port > -1:
             cmdArgs += ["--port", str(self.getPort(role))]
+            if self.exposeUnixSocket:
+                cmdArgs += ["--unixsocket", self.getUnixPath(role)]
+                cmdArgs += ["--unixsocketperm", "700"]
         else:
             cmdArgs += ["--port", str(0), "--unixsocket", self.getUnixPath(role)]
 
@@ -200,10 +421,7 @@ class StandardEnv(object):
         if self.noLog:
             cmdArgs += ["--logfile", "/dev/null"]
         elif self.outputFilesFormat is not None and not self.noCatch:
-            cmdArgs += [
-                "--logfile",
-                self.remstate + "/log/" + self._getFileName(role, ".log"),
-            ]
+            cmdArgs += ["--logfile", self._getLogFilePath(role)]
         if self.outputFilesFormat is not None:
             cmdArgs += [
                 "--dbfilename",
@@ -221,7 +439,7 @@ class StandardEnv(object):
                 "--cluster-enabled",
                 "yes",
                 "--cluster-config-file",
-                self.remstate + "/cfg/" + self._getFileName(role, ".cluster.conf"),
+                self._getClusterConfigPath(role),
                 "--cluster-node-timeout",
                 "5000"
                 if self.clusterNodeTimeout is None
@@ -234,11 +452,116 @@ class StandardEnv(object):
                 cmdArgs += ["--aof-use-rdb-preamble", "no"]
 
         if self.enableDebugCommand:
-            if self._getRedisVersion() > 70000:
+            if binary_supports(self._probeBinary(), "enable-debug-command"):
                 cmdArgs += ["--enable-debug-command", "yes"]
 
+        if self.ioThreads and self.ioThreads > 1:
+            if binary_supports(self._probeBinary(), "io-threads"):
+                cmdArgs += ["--io-threads", str(self.ioThreads)]
+
+        applied = self.checkProfile()["settings"] if self.profile else {}
+        for option, value in self.profileSettings.items():
+            if option in applied:
+                cmdArgs += ["--" + option] + (value.split() or [""])
+
         return cmdArgs
 
+    def checkProfile(self):
+        """Split the profile settings into those the binary takes and the skipped ones"""
+        if self.appliedProfile is None and self.profile:
+            probe = self._probeBinary()
+            applied, skipped = {}, []
+            for option, value in self.profile["settings"].items():
+                if binary_supports(probe, option):
+                    applied[option] = value
+                else:
+                    skipped.append(option)
+            self.appliedProfile = {"settings": applied, "skipped": skipped}
+        return self.appliedProfile
+
+    def toState(self):
+        """Describe the env as plain data, see fromState"""
+        servers = []
+        for role in [MASTER, SLAVE] if self.useSlaves else [MASTER]:
+            servers.append(
+                {
+                    "role": role,
+                    "serverId": self.getServerId(role),
+                    "port": self.getPort(role),
+                    "pid": self.getPid(role),
+                    "logFile": self._getLogFilePath(role),
+                    "rdbFile": self._getRdbFilePath(role),
+                    "unixSocket": self.getUnixPath(role)
+                    if self.useUnix or self.exposeUnixSocket
+                    else None,
+                    "cpus": self._getCpuAffinity(role),
+                }
+            )
+        return {
+            "uuid": self.uuid,
+            "config": {
+                "redisBinaryPath": self.redisBinaryPath,
+                "remstate": self.remstate,
+                "modulePath": self.modulePath,
+                "moduleArgs": self.moduleArgs,
+                "outputFilesFormat": self.outputFilesFormat[len(self.uuid) + 1 :],
+                "dbDirPath": self.dbDirPath,
+                "useSlaves": self.useSlaves,
+                "password": self.password,
+                "libPath": self.libPath,
+                "clusterEnabled": self.clusterEnabled,
+                "decodeResponses": self.decodeResponses,
+                "useAof": self.useAof,
+                "useRdbPreamble": self.useRdbPreamble,
+                "sanitizer": self.sanitizer,
+                "noCatch": self.noCatch,
+                "noLog": self.noLog,
+                "unix": self.useUnix,
+                "unixSocket": self.exposeUnixSocket,
+                "verbose": self.verbose,
+                "clusterNodeTimeout": self.clusterNodeTimeout,
+                "enableDebugCommand": self.enableDebugCommand,
+                "name": self.name,
+                "ioThreads": self.ioThreads,
+                "cpuAffinity": self.cpuAffinity,
+                "numaNode": self.numaNode,
+                "profile": self.profile,
+                "ephemeralDir": self.ephemeralDir,
+            },
+            "servers": servers,
+            "portLease": self.portLease,
+            "appliedProfile": self.appliedProfile,
+        }
+
+    @classmethod
+    def fromState(cls, state):
+        """Re-attach to servers described by toState
+
+        The env is set up like __init__ does but without taking ports, and
+        command lines are only built if it is started again, so re-attaching
+        never probes the redis binary.
+        """
+        master = state["servers"][0]
+        env = cls.__new__(cls)
+        env._setFields(
+            serverId=master["serverId"], envUuid=state["uuid"], **state["config"]
+        )
+        env.port = master["port"]
+        env.masterProcess = master["pid"]
+        env.slavePort = 0
+        if env.useSlaves:
+            slave = state["servers"][1]
+            env.slaveServerId = slave["serverId"]
+            env.slavePort = slave["port"]
+            env.slaveProcess = slave["pid"]
+        env.portLease = state["portLease"]
+        env.appliedProfile = state.get("appliedProfile")
+        env.envIsUp = bool(env._getPids())
+        env.envIsHealthy = env.masterProcess is not None and (
+            env.slaveProcess is not None if env.useSlaves else True
+        )
+        return env
+
     def createCmdOSEnv(self, role):
         if self.sanitizer != "addr" and self.sanitizer != "address":
             return self.environ
@@ -250,10 +573,53 @@ class StandardEnv(object):
         )
         return osenv
 
-    def waitForRedisToStart(self, con):
-        wait_for_conn(con, retries=1000 if self.debugger else 200)
+    def waitForRedisToStart(self, con, proc=None, role=MASTER, logOffset=0):
+        if proc is None:
+            wait_for_conn(con, retries=1000 if self.debugger else 200)
+            self._waitForAOFChild(con)
+            return
+
+        status, lines = wait_for_server(
+            proc,
+            con,
+            logPath=self._getLogFilePath(role),
+            logOffset=logOffset,
+            timeout=100 if self.debugger else 20,
+        )
+        if status != "ready":
+            name = "%s-%d" % (role, self.getServerId(role))
+            if status == "exited":
+                console.print(
+                    "[red]Redis %s exited during startup with code %s[/red]"
+                    % (name, proc.returncode)
+                )
+                if role == MASTER:
+                    self.masterProcess, self.masterExitCode = None, proc.returncode
+                else:
+                    self.slaveProcess, self.slaveExitCode = None, proc.returncode
+                self._printServerOutput(proc)
+            elif status == "fatal":
+                console.print("[red]Redis %s logged a fatal error[/red]" % name)
+                try:
+                    # let the server finish writing its report
+                    proc.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    pass
+                lines = self._readServerLog(role, logOffset) or lines
+            else:
+                console.print("[red]Redis %s did not become ready[/red]" % name)
+            self._printServerLog(role, lines)
+            self.failedRoles.add(role)
+            raise Exception("Redis %s failed to start: %s" % (name, status))
+
+        # the log says ready, make sure the server answers too
+        wait_for_conn(con, retries=50)
         self._waitForAOFChild(con)
 
+    def _getLogOffset(self, role):
+        path = self._getLogFilePath(role)
+        return os.path.getsize(path) if path and os.path.exists(path) else 0
+
     def getPid(self, role):
         return self.masterProcess if role == MASTER else self.slaveProcess
 
@@ -270,9 +636,19 @@ class StandardEnv(object):
 
         else:
             console.print(prefix + "port: %d" % (self.getPort(role)))
+            if self.exposeUnixSocket:
+                console.print(
+                    prefix + "unix_socket_path: %s" % (self.getUnixPath(role))
+                )
         console.print(prefix + "binary path: %s" % (self.redisBinaryPath))
         console.print(prefix + "server id: %d" % (self.getServerId(role)))
         console.print(prefix + "using debugger: {}".format(bool(self.debugger)))
+        if self._getCpuAffinity(role):
+            console.print(prefix + "cpus: %s" % format_cpu_list(self._getCpuAffinity(role)))
+        if self.ioThreads:
+            console.print(prefix + "io threads: %d" % self.ioThreads)
+        if self.profile:
+            console.print(prefix + "profile: %s" % self.profile["name"])
         if self.modulePath:
             console.print(prefix + "module: %s" % (self.modulePath))
             if self.moduleArgs:
@@ -307,6 +683,8 @@ class StandardEnv(object):
         if self.has_interactive_debugger:
             stdinPipe = sys.stdin
 
+        self._makeStateDirs()
+
         options = {
             "stderr": stderrPipe,
             "stdin": stdinPipe,
@@ -314,90 +692,231 @@ class StandardEnv(object):
         }
 
         if self.verbose:
-            console.print("[cyan]Redis master command:[/cyan] " + " ".join(self.masterCmdArgs))
+            console.print("[cyan]Redis master command:[/cyan] " + " ".join(self.getCmdArgs(MASTER)))
         if masters and self.masterProcess is None:
-            self.masterProcess = subprocess.Popen(
-                args=self.masterCmdArgs, env=self.masterOSEnv, **options
-            ).pid
+            logOffset = self._getLogOffset(MASTER)
+            proc = subprocess.Popen(
+                args=self.getCmdArgs(MASTER), env=self.masterOSEnv, **options
+            )
+            self.masterProcess = proc.pid
+            self._applyCpuAffinity(MASTER)
             con = self.getConnection()
-            self.waitForRedisToStart(con)
+            self.waitForRedisToStart(con, proc, MASTER, logOffset)
+            # pin the threads the server spawned while starting up too
+            self._applyCpuAffinity(MASTER)
         if self.useSlaves and slaves and self.slaveProcess is None:
             if self.verbose:
-                console.print("Redis slave command: " + " ".join(self.slaveCmdArgs))
-            self.slaveProcess = subprocess.Popen(
-                args=self.slaveCmdArgs, env=self.slaveOSEnv, **options
-            ).pid
+                console.print("Redis slave command: " + " ".join(self.getCmdArgs(SLAVE)))
+            logOffset = self._getLogOffset(SLAVE)
+            proc = subprocess.Popen(
+                args=self.getCmdArgs(SLAVE), env=self.slaveOSEnv, **options
+            )
+            self.slaveProcess = proc.pid
+            self._applyCpuAffinity(SLAVE)
             con = self.getSlaveConnection()
-            self.waitForRedisToStart(con)
+            self.waitForRedisToStart(con, proc, SLAVE, logOffset)
+            self._applyCpuAffinity(SLAVE)
         self.envIsUp = True
         self.envIsHealthy = self.masterProcess is not None and (
             self.slaveProcess is not None if self.useSlaves else True
         )
+        if self.portLease:
+            bind_port_lease(self.portLease, self._getPids())
 
-    def _isAlive(self, pid):
-        return psutil.pid_exists(pid)
+    def _getCpuAffinity(self, role):
+        return (self.cpuAffinity or {}).get(role)
+
+    def _applyCpuAffinity(self, role):
+        cpus = self._getCpuAffinity(role)
+        if cpus and self.getPid(role):
+            set_process_affinity(self.getPid(role), cpus)
+
+    def _getPids(self):
+        return [pid for pid in (self.masterProcess, self.slaveProcess) if pid]
 
-    def _stopProcess(self, role):
-        pid = self.masterProcess if role == MASTER else self.slaveProcess
+    def _isAlive(self, pid):
+        if not pid:
+            return False
+        try:
+            # a crashed server nobody reaped yet lingers as a zombie
+            return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
+
+    def _signalStop(self, role, noSave=False, timeout_sec=10):
+        """Ask a server to stop and return the processes to wait for
+
+        With noSave the server is sent SHUTDOWN NOSAVE, waiting at most
+        timeout_sec for it; a server that cannot take it gets SIGTERM.
+        """
+        pid = self.getPid(role)
         if not self._isAlive(pid):
+            self.failedRoles.add(role)
             if not self.has_interactive_debugger:
                 if self.outputFilesFormat is not None and not self.noCatch:
                     self.verbose_analyse_server_log(role)
-            return
+            return []
 
         p0 = psutil.Process(pid=pid)
         pchi = p0.children(recursive=True)
-        for p in pchi:
+        if noSave:
+            # connect, ping and shutdown each get half the time at most
+            timeout = max(timeout_sec / 2, 0.1)
+            con = self._getConnection(
+                role,
+                socket_timeout=timeout,
+                socket_connect_timeout=timeout,
+                retry=Retry(NoBackoff(), 0),
+            )
+            sent = False
+            try:
+                con.ping()
+                sent = True
+                con.execute_command("SHUTDOWN", "NOSAVE")
+            except redis.ConnectionError as e:
+                # once SHUTDOWN is sent the server drops the connection as it exits
+                if not sent:
+                    noSave = self._noSaveFailed(role, pid, e)
+            except redis.RedisError as e:
+                noSave = self._noSaveFailed(role, pid, e)
+            finally:
+                con.close()
+        for p in pchi if noSave else pchi + [p0]:
             try:
                 p.terminate()
-                exit_code = p.wait(timeout=3)
-            except Exception as e:
-                print(e)
+            except psutil.NoSuchProcess:
                 pass
+        return pchi + [p0]
 
-        p0.terminate()
-        exit_code = p0.wait(timeout=3)
+    def _noSaveFailed(self, role, pid, error):
+        console.print(
+            "[yellow]Redis %s-%d (pid %d) did not take SHUTDOWN NOSAVE, "
+            "stopping it with SIGTERM which saves its data: %s[/yellow]"
+            % (role, self.getServerId(role), pid, error)
+        )
+        return False
 
+    def _reapStopped(self, role, procs):
+        """Record the exit code of a stopped server"""
+        if not procs:
+            return
+        exit_code = getattr(procs[-1], "returncode", None)
         if role == MASTER:
             self.masterExitCode = exit_code
         else:
             self.slaveExitCode = exit_code
 
+    def _persistenceStats(self, role):
+        """Save counters of a running server, used to estimate the writes it made"""
+        try:
+            info = self._getConnection(
+                role,
+                socket_timeout=1,
+                socket_connect_timeout=1,
+                retry=Retry(NoBackoff(), 0),
+            ).info("persistence")
+        except Exception:
+            return {}
+        rdbPath = self._getRdbFilePath(role)
+        return {
+            "rdbSaves": int(info.get("rdb_saves", 0)),
+            "rdbSize": os.path.getsize(rdbPath) if os.path.exists(rdbPath) else 0,
+            "aofRewrites": int(info.get("aof_rewrites", 0)),
+            "aofBaseSize": int(info.get("aof_base_size", 0)),
+        }
+
+    def _keepFailedLogs(self):
+        """Copy logs of failed servers out of the ephemeral dir, return their paths"""
+        kept = []
+        for role in [MASTER, SLAVE] if self.useSlaves else [MASTER]:
+            path = self._getLogFilePath(role)
+            if not path or not os.path.exists(path):
+                continue
+            if role in self.failedRoles or analyse_server_log(self._readServerLog(role)):
+                logDir = self._getStateDirPath("log", persistent=True)
+                os.makedirs(logDir, exist_ok=True)
+                kept.append(shutil.copy(path, logDir))
+        return kept
+
     def verbose_analyse_server_log(self, role):
-        path = "{0}".format(self._getFileName(role, ".log"))
-        if self.dbDirPath is not None:
-            path = "{0}/{1}".format(self.dbDirPath, self._getFileName(role, ".log"))
-        console.print("\t" + "check the redis log at: {0}".format(path))
-        console.print("\t" + "Printing only REDIS BUG REPORT START and STACK TRACE")
-
-        with open(path) as file:
-            bug_report_found = False
-            for line in file:
-                if "REDIS BUG REPORT START" in line:
-                    bug_report_found = True
-                if "------ INFO OUTPUT ------" in line:
-                    break
-                if bug_report_found is True:
-                    console.print("\t\t" + line.rstrip())
-
-    def stopEnv(self, masters=True, slaves=True):
+        lines = self._readServerLog(role)
+        if lines:
+            self._printServerLog(role, lines)
+
+    def _readServerLog(self, role, offset=0):
+        path = self._getLogFilePath(role)
+        if path is None or not os.path.exists(path):
+            return []
+        with open(path, errors="replace") as file:
+            file.seek(offset)
+            return file.readlines()
+
+    def _printServerOutput(self, proc, tail=20):
+        """Print what the server wrote to stdout and stderr, where config
+        errors go before its log file is open"""
+        try:
+            output = proc.communicate(timeout=1)[0]
+        except (subprocess.TimeoutExpired, ValueError):
+            return
+        lines = (output or b"").decode("utf-8", "replace").rstrip().splitlines()
+        if lines:
+            console.print("\t" + "Printing last %d output lines" % len(lines[-tail:]))
+        for line in lines[-tail:]:
+            console.print("\t\t" + line, markup=False, highlight=False)
+
+    def _printServerLog(self, role, lines, tail=20):
+        path = self._getLogFilePath(role)
+        if path is not None:
+            console.print("\t" + "check the redis log at: {0}".format(path))
+        report = analyse_server_log(lines)
+        if report:
+            console.print("\t" + "Printing only REDIS BUG REPORT START and STACK TRACE")
+        else:
+            report = [line.rstrip() for line in lines[-tail:]]
+            if report:
+                console.print("\t" + "Printing last %d log lines" % len(report))
+        for line in report:
+            console.print("\t\t" + line, markup=False, highlight=False)
+
+    def _rolesToStop(self, masters=True, slaves=True):
+        roles = []
         if self.masterProcess is not None and masters is True:
-            self._stopProcess(MASTER)
-            self.masterProcess = None
+            roles.append(MASTER)
         if self.useSlaves and self.slaveProcess is not None and slaves is True:
-            self._stopProcess(SLAVE)
+            roles.append(SLAVE)
+        return roles
+
+    def _markStopped(self, role):
+        if role == MASTER:
+            self.masterProcess = None
+        else:
             self.slaveProcess = None
         self.envIsUp = self.masterProcess is not None or self.slaveProcess is not None
         self.envIsHealthy = self.masterProcess is not None and (
             self.slaveProcess is not None if self.useSlaves else True
         )
 
-    def _getConnection(self, role):
+    def stopEnv(self, masters=True, slaves=True, timeout_sec=10, noSave=False):
+        deadline = time.time() + timeout_sec
+        stopping = [
+            (self, role, self._signalStop(role, noSave, timeout_sec))
+            for role in self._rolesToStop(masters, slaves)
+        ]
+        wait_for_stop(stopping, max(deadline - time.time(), 0))
+        self.envIsUp = self.masterProcess is not None or self.slaveProcess is not None
+        self.envIsHealthy = self.masterProcess is not None and (
+            self.slaveProcess is not None if self.useSlaves else True
+        )
+        if self.portLease and not self.envIsUp:
+            release_ports(self.portLease)
+
+    def _getConnection(self, role, **kwargs):
         if self.useUnix:
             return redis.Redis(
                 unix_socket_path=self.getUnixPath(role),
                 password=self.password,
                 decode_responses=self.decodeResponses,
+                **kwargs,
             )
 
         return redis.Redis(
@@ -405,8 +924,22 @@ class StandardEnv(object):
             self.getPort(role),
             password=self.password,
             decode_responses=self.decodeResponses,
+            **kwargs,
         )
 
+    def getClient(self, role=MASTER, unix=False, resp3=False):
+        """Return a pooled client to a server"""
+        kwargs = {
+            "password": self.password,
+            "decode_responses": True,
+            "protocol": 3 if resp3 else 2,
+        }
+        if unix:
+            if not (self.useUnix or self.exposeUnixSocket):
+                raise ValueError("Server %d has no unix socket" % self.getServerId(role))
+            return redis.Redis(unix_socket_path=self.getUnixPath(role), **kwargs)
+        return redis.Redis("localhost", self.getPort(role), **kwargs)
+
     def getConnection(self, shardId=1):
         return self._getConnection(MASTER)
 
@@ -429,6 +962,8 @@ class StandardEnv(object):
 
 class ClusterEnv(object):
     def __init__(self, **kwargs):
+        self.uuid = uuid.uuid4().hex
+        self.name = kwargs.get("name")
         self.shards = []
         self.envIsUp = False
         self.envIsHealthy = False
@@ -441,16 +976,153 @@ class ClusterEnv(object):
         startPort = kwargs.pop("port", 10000)
         totalRedises = self.shardsCount * (2 if useSlaves else 1)
         randomizePorts = kwargs.pop("randomizePorts", False)
-        for i in range(0, totalRedises, (2 if useSlaves else 1)):
-            port = 0 if randomizePorts else startPort
-            shard = StandardEnv(
-                port=port,
-                serverId=(i + 1),
-                clusterEnabled=True,
-                **kwargs,
+        ports = kwargs.pop("ports", None)
+        if ports is not None and len(ports) != self.shardsCount:
+            raise ValueError(
+                "Got %d ports for %d shards" % (len(ports), self.shardsCount)
             )
-            self.shards.append(shard)
-            startPort += 2
+        self.useSlaves = useSlaves
+        # check everything that may be wrong before taking any ports
+        self.placement = kwargs.pop("placement", PLACEMENT_NONE)
+        self.profile = kwargs.get("profile")
+        placementPlan = plan_cpu_placement(
+            self.placement,
+            self.shardsCount,
+            2 if useSlaves else 1,
+            cpusPerServer=max(1, int(self._ioThreads(kwargs))),
+        )
+        self.fromTemplate = False
+        self.startupTime = None
+        # seconds spent in each start and stop phase of the last run
+        self.phaseTimes = {}
+        self.bootstrap = kwargs.pop("bootstrap", BOOTSTRAP_MESH)
+        if self.bootstrap not in BOOTSTRAPS:
+            raise ValueError("Unknown cluster bootstrap mode: %s" % self.bootstrap)
+        self.convergenceTime = None
+        self.slotRanges = allocate_slots(
+            self.shardsCount,
+            weights=kwargs.pop("slotWeights", None),
+            ranges=kwargs.pop("slotRanges", None),
+        )
+        self.ephemeralDir = kwargs.get("ephemeralDir")
+        self.ephemeralReport = None
+
+        self.portLease = None
+        if ports is None:
+            # lease one block of ports for the whole cluster, fixed ones included
+            # so that clusters started at the same time never share ports
+            self.portLease = self.uuid
+            if not randomizePorts and not reserve_ports(
+                startPort, 2 * self.shardsCount, self.portLease
+            ):
+                raise Exception(
+                    "Ports %d-%d are in use"
+                    % (startPort, startPort + 2 * self.shardsCount - 1)
+                )
+            if randomizePorts:
+                ports = lease_ports(totalRedises, self.portLease)[:: 2 if useSlaves else 1]
+        else:
+            # fixed ports, e.g. of a template, still go through the lease
+            self.portLease = self.uuid
+            blocks = port_blocks(ports, 2 if useSlaves else 1)
+            for first, count in blocks:
+                if not reserve_ports(first, count, self.portLease):
+                    release_ports(self.portLease)
+                    raise Exception(
+                        "Ports %d-%d are in use" % (first, first + count - 1)
+                    )
+
+        ephemeral = kwargs.pop("ephemeral", False)
+        try:
+            if ephemeral:
+                self.ephemeralDir = kwargs["ephemeralDir"] = tempfile.mkdtemp(
+                    prefix="redisero-%s-" % (kwargs.get("name") or "default"),
+                    dir=ephemeral_root(),
+                )
+            for n, i in enumerate(range(0, totalRedises, (2 if useSlaves else 1))):
+                port = ports[n] if ports is not None else startPort
+                if placementPlan:
+                    kwargs["cpuAffinity"] = dict(
+                        zip([MASTER, SLAVE], placementPlan[n]["cpus"])
+                    )
+                    kwargs["numaNode"] = placementPlan[n]["node"]
+                shard = StandardEnv(
+                    port=port,
+                    serverId=(i + 1),
+                    clusterEnabled=True,
+                    **kwargs,
+                )
+                self.shards.append(shard)
+                startPort += 2
+        except BaseException:
+            release_ports(self.portLease)
+            if ephemeral and self.ephemeralDir:
+                shutil.rmtree(self.ephemeralDir, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def _ioThreads(kwargs):
+        if kwargs.get("ioThreads"):
+            return kwargs["ioThreads"]
+        profile = kwargs.get("profile")
+        return profile["settings"].get("io-threads", 1) if profile else 1
+
+    def toState(self):
+        """Describe the cluster as plain data, see fromState"""
+        shards = []
+        for shard, ranges in zip(self.shards, self.slotRanges):
+            shard_state = shard.toState()
+            shard_state["slots"] = ranges
+            shards.append(shard_state)
+        return {
+            "uuid": self.uuid,
+            "name": self.name,
+            "bootstrap": self.bootstrap,
+            "placement": self.placement,
+            "profile": self.profile and self.profile["name"],
+            "ephemeralDir": self.ephemeralDir,
+            "useSlaves": self.useSlaves,
+            "modulePath": self.modulePath,
+            "moduleArgs": self.moduleArgs,
+            "slotRanges": self.slotRanges,
+            "portLease": self.portLease,
+            "startupTime": self.startupTime,
+            "convergenceTime": self.convergenceTime,
+            "shards": shards,
+        }
+
+    @classmethod
+    def fromState(cls, state):
+        """Re-attach to a running cluster described by toState, see StandardEnv.fromState"""
+        env = cls.__new__(cls)
+        env.uuid = state["uuid"]
+        env.name = state["name"]
+        env.shards = [StandardEnv.fromState(shard) for shard in state["shards"]]
+        env.shardsCount = len(env.shards)
+        env.modulePath = state["modulePath"]
+        env.moduleArgs = state["moduleArgs"]
+        env.useSlaves = state["useSlaves"]
+        env.password = env.shards[0].password if env.shards else None
+        env.decodeResponses = env.shards[0].decodeResponses if env.shards else False
+        env.portLease = state["portLease"]
+        env.placement = state.get("placement", PLACEMENT_NONE)
+        # the state only names the profile, the shards hold its settings
+        env.profile = env.shards[0].profile if env.shards else None
+        env.ephemeralDir = state.get("ephemeralDir")
+        env.ephemeralReport = None
+        env.fromTemplate = False
+        env.startupTime = state["startupTime"]
+        env.phaseTimes = {}
+        env.bootstrap = state["bootstrap"]
+        env.convergenceTime = state["convergenceTime"]
+        env.slotRanges = [
+            [tuple(slot_range) for slot_range in ranges] for ranges in state["slotRanges"]
+        ]
+        env.envIsUp = any(shard.envIsUp for shard in env.shards)
+        env.envIsHealthy = env.envIsUp and all(
+            shard.envIsHealthy for shard in env.shards
+        )
+        return env
 
     def printEnvData(self, prefix=""):
         console.print(prefix + "Info:")
@@ -463,6 +1135,149 @@ class ClusterEnv(object):
             console.print(prefix + "Shard: %d" % (i + 1))
             shard.printEnvData(prefix + "\t")
 
+    @staticmethod
+    def _clusterInfo(con):
+        status = con.execute_command("CLUSTER", "INFO")
+        if isinstance(status, dict):
+            return status
+        if isinstance(status, bytes):
+            status = status.decode("utf-8")
+        return dict(
+            line.split(":", 1) for line in status.splitlines() if ":" in line
+        )
+
+    def _meetMesh(self):
+        for shard in self.shards:
+            con = shard.getConnection()
+            for s in self.shards:
+                con.execute_command("CLUSTER", "MEET", "127.0.0.1", s.getMasterPort())
+
+    def _meetStar(self):
+        # a single star of meets through the seed, gossip spreads the rest
+        con = self.shards[0].getConnection()
+        for shard in self.shards[1:]:
+            con.execute_command("CLUSTER", "MEET", "127.0.0.1", shard.getMasterPort())
+
+    def _assignSlots(self):
+        # ADDSLOTSRANGE is available from redis 7.0
+        useRanges = self.shards[0]._getRedisVersion() >= 70000
+        for shard, ranges in zip(self.shards, self.slotRanges):
+            if not ranges:
+                continue
+            con = shard.getConnection()
+            if useRanges:
+                args = [slot for slot_range in ranges for slot in slot_range]
+                con.execute_command("CLUSTER", "ADDSLOTSRANGE", *args)
+            else:
+                args = [
+                    slot for start, end in ranges for slot in range(start, end + 1)
+                ]
+                con.execute_command("CLUSTER", "ADDSLOTS", *args)
+
+    def _verifySlotCoverage(self):
+        """Check that the cluster serves the slot ranges we assigned"""
+        expected = {
+            shard.getMasterPort(): merge_slot_ranges(ranges)
+            for shard, ranges in zip(self.shards, self.slotRanges)
+            if ranges
+        }
+        served = {}
+        for entry in self.shards[0].getConnection().execute_command("CLUSTER", "SLOTS"):
+            port = int(entry[2][1])
+            served.setdefault(port, []).append((int(entry[0]), int(entry[1])))
+        served = {port: merge_slot_ranges(ranges) for port, ranges in served.items()}
+        if served != expected:
+            raise RuntimeError(
+                "Cluster slot coverage mismatch, expected %s got %s" % (expected, served)
+            )
+
+    def saveTemplate(self, path, withData=False):
+        """Snapshot the bootstrapped topology so it can be restarted as is"""
+        os.makedirs(path, exist_ok=True)
+        for n, shard in enumerate(self.shards):
+            con = shard.getConnection()
+            con.execute_command("CLUSTER", "SAVECONFIG")
+            shutil.copyfile(
+                shard._getClusterConfigPath(MASTER),
+                os.path.join(path, "node-%d.conf" % n),
+            )
+            if withData:
+                con.execute_command("SAVE")
+                shutil.copyfile(
+                    shard._getRdbFilePath(MASTER), os.path.join(path, "node-%d.rdb" % n)
+                )
+        manifest = {
+            "version": TEMPLATE_VERSION,
+            "shardsCount": len(self.shards),
+            "useSlaves": bool(self.useSlaves),
+            "ports": [shard.getMasterPort() for shard in self.shards],
+            "slotRanges": self.slotRanges,
+            "withData": withData,
+            "coldStartTime": self.startupTime,
+        }
+        write_file_atomic(
+            os.path.join(path, TEMPLATE_MANIFEST), json.dumps(manifest, indent=2)
+        )
+
+    @staticmethod
+    def readTemplate(path):
+        with open(os.path.join(path, TEMPLATE_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != TEMPLATE_VERSION:
+            raise ValueError(
+                "Unsupported cluster template version: %s" % manifest.get("version")
+            )
+        return manifest
+
+    def loadTemplate(self, path):
+        """Seed the shards with the cluster config (and data) saved in a template"""
+        manifest = self.readTemplate(path)
+        if [shard.getMasterPort() for shard in self.shards] != manifest["ports"]:
+            raise ValueError("Cluster ports do not match the template")
+        for n, shard in enumerate(self.shards):
+            shard._makeStateDirs()
+            shutil.copyfile(
+                os.path.join(path, "node-%d.conf" % n),
+                shard._getClusterConfigPath(MASTER),
+            )
+            if manifest["withData"]:
+                shutil.copyfile(
+                    os.path.join(path, "node-%d.rdb" % n),
+                    shard._getRdbFilePath(MASTER),
+                )
+        self.slotRanges = [
+            [tuple(slot_range) for slot_range in ranges]
+            for ranges in manifest["slotRanges"]
+        ]
+        self.fromTemplate = True
+        return manifest
+
+    def waitConvergence(self, timeout_sec=40):
+        """Wait until every node knows about every other node"""
+        st = time.time()
+        pending = list(self.shards)
+        while st + timeout_sec > time.time():
+            for shard in list(pending):
+                try:
+                    info = self._clusterInfo(shard.getConnection())
+                except Exception as e:
+                    print("got error on cluster info, will try again, %s" % str(e))
+                    continue
+                if int(info.get("cluster_known_nodes", 0)) == len(self.shards):
+                    pending.remove(shard)
+            if not pending:
+                self.convergenceTime = time.time() - st
+                console.print(
+                    "Cluster topology converged in %.3f seconds"
+                    % self.convergenceTime
+                )
+                return
+            time.sleep(0.05)
+        raise RuntimeError(
+            "Cluster gossip convergence timed out after %s seconds, %d of %d "
+            "nodes still incomplete" % (timeout_sec, len(pending), len(self.shards))
+        )
+
     def waitCluster(self, timeout_sec=40):
 
         st = time.time()
@@ -496,46 +1311,121 @@ class ClusterEnv(object):
             "Cluster OK wait loop timed out after %s seconds" % timeout_sec
         )
 
+    def _runOnShards(self, fn):
+        """Run fn on every shard concurrently, re-raise the first failure"""
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            futures = [executor.submit(fn, shard) for shard in self.shards]
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
     def startEnv(self, masters=True, slaves=True):
         if self.envIsUp == True:
             print("Env already running")
             return  # env is already up
+        self._warnSkippedProfileOptions()
+        st = time.time()
+        self.phaseTimes = {}
         try:
-            for shard in self.shards:
-                shard.startEnv(masters, slaves)
+            # spawn all masters at once, then all slaves once masters are up
+            self._runOnShards(lambda shard: shard.startEnv(masters, False))
+            self.phaseTimes["spawnMasters"] = time.time() - st
+            phaseSt = time.time()
+            self._runOnShards(lambda shard: shard.startEnv(False, slaves))
+            self.phaseTimes["spawnSlaves"] = time.time() - phaseSt
         except Exception:
-            for shard in self.shards:
-                shard.stopEnv()
+            self._abortStart()
             raise
 
-        slots_per_node = int(16384 / len(self.shards)) + 1
-        for i, shard in enumerate(self.shards):
-            con = shard.getConnection()
-            for s in self.shards:
-                con.execute_command("CLUSTER", "MEET", "127.0.0.1", s.getMasterPort())
+        try:
+            # nodes started from a template already know the topology
+            phaseSt = time.time()
+            if not self.fromTemplate:
+                if self.bootstrap == BOOTSTRAP_STAR:
+                    self._meetStar()
+                else:
+                    self._meetMesh()
+                self._assignSlots()
+                if self.bootstrap == BOOTSTRAP_STAR:
+                    self.waitConvergence()
+            self.phaseTimes["bootstrap"] = time.time() - phaseSt
+            phaseSt = time.time()
+            self.waitCluster()
+            self._verifySlotCoverage()
+            self.phaseTimes["waitCluster"] = time.time() - phaseSt
+        except Exception:
+            self._abortStart()
+            raise
+        self.startupTime = time.time() - st
+        if self.portLease:
+            bind_port_lease(
+                self.portLease, [pid for shard in self.shards for pid in shard._getPids()]
+            )
+        self.envIsUp = True
+        self.envIsHealthy = True
 
-            start_slot = i * slots_per_node
-            end_slot = start_slot + slots_per_node
-            if end_slot > 16384:
-                end_slot = 16384
+    def _warnSkippedProfileOptions(self):
+        report = self.shards[0].checkProfile() if self.shards else None
+        for option in report["skipped"] if report else []:
+            console.print(
+                "[yellow]Profile %s: %s is not supported by %s, skipped[/yellow]"
+                % (self.profile["name"], option, self.shards[0].redisBinaryPath)
+            )
 
-            try:
-                con.execute_command(
-                    "CLUSTER",
-                    "ADDSLOTS",
-                    *(str(x) for x in range(start_slot, end_slot)),
-                )
-            except Exception:
-                pass
+    def _abortStart(self):
+        self.stopEnv(noSave=True)
+        if self.ephemeralReport:
+            for path in self.ephemeralReport["keptLogs"]:
+                console.print("Log of the failed shard kept at: %s" % path)
 
-        self.waitCluster()
-        self.envIsUp = True
-        self.envIsHealthy = True
+    def stopEnv(self, masters=True, slaves=True, timeout_sec=10, noSave=False):
+        st = time.time()
+        # signal every server first, then wait on all of them together
+        roles = [
+            (shard, role)
+            for shard in self.shards
+            for role in shard._rolesToStop(masters, slaves)
+        ]
+        with ThreadPoolExecutor(max_workers=max(len(roles), 1)) as executor:
+            stats = []
+            if self.ephemeralDir:
+                stats = list(executor.map(lambda sr: sr[0]._persistenceStats(sr[1]), roles))
+            procs = list(
+                executor.map(
+                    lambda sr: sr[0]._signalStop(sr[1], noSave, timeout_sec), roles
+                )
+            )
+        wait_for_stop(
+            [(shard, role, p) for (shard, role), p in zip(roles, procs)],
+            max(st + timeout_sec - time.time(), 0),
+        )
+        self.phaseTimes["stop"] = time.time() - st
 
-    def stopEnv(self, masters=True, slaves=True):
         self.envIsUp = False
         self.envIsHealthy = False
         for shard in self.shards:
-            shard.stopEnv(masters, slaves)
             self.envIsUp = self.envIsUp or shard.envIsUp
             self.envIsHealthy = self.envIsHealthy and shard.envIsUp
+        if self.portLease and not self.envIsUp:
+            release_ports(self.portLease)
+        if self.ephemeralDir and not self.envIsUp:
+            self._dropEphemeralDir(stats)
+
+    def _dropEphemeralDir(self, stats):
+        """Keep the logs of failed shards and remove the RAM backed state"""
+        keptLogs = [path for shard in self.shards for path in shard._keepFailedLogs()]
+        finalBytes = dir_size(self.ephemeralDir)
+        # final files plus every earlier rdb save and aof rewrite they replaced
+        rewrittenBytes = sum(
+            s.get("rdbSaves", 0) * s.get("rdbSize", 0)
+            + s.get("aofRewrites", 0) * s.get("aofBaseSize", 0)
+            for s in stats
+        )
+        self.ephemeralReport = {
+            "path": self.ephemeralDir,
+            "bytesSaved": finalBytes + rewrittenBytes,
+            "rdbSaves": sum(s.get("rdbSaves", 0) for s in stats),
+            "aofRewrites": sum(s.get("aofRewrites", 0) for s in stats),
+            "keptLogs": keptLogs,
+        }
+        shutil.rmtree(self.ephemeralDir, ignore_errors=True)
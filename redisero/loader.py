@@ -1,6 +1,11 @@
+import glob
+import hashlib
 import json
 import os
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import yaml
@@ -8,22 +13,162 @@ from rich.console import Console
 
 from . import utils
 from .schemas import Module, StateDir
+from .state import write_file_atomic
 
 console = Console()
-MODULE_PACKAGE_DEFAULT_NAME = "module.zip"
+DOWNLOAD_DIR = ".download"
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 MODULE_METADATA_FILE = "module.json"
 NPM_METADATA_FILE = "modules.json"
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+LOCK_FILE = "modules.lock"
+LOCK_VERSION = 1
+
+
+def module_key(module: Module) -> str:
+    """Artifact cache key of a module: name, version and platform"""
+    return f"{module.name}@{module.version or 'latest'}/{module.platform.lower()}"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class ModuleLoader:
-    def __init__(self, cfg_path: str, state_dir_path: str) -> None:
+    def __init__(
+        self,
+        cfg_path: str,
+        state_dir_path: str,
+        download_workers: int = DOWNLOAD_WORKERS,
+    ) -> None:
         # todo check if files exists
         self.cfg_path = cfg_path
         self.state_dir_path = state_dir_path
+        self.download_workers = download_workers
         self.modules = []
+        self.manifest_path = f"{state_dir_path}/{StateDir.MOD.value}/{MANIFEST_FILE}"
+        self.manifest, self.load_lists = self._load_manifest()
+        self.lock_path = os.path.join(os.path.dirname(cfg_path), LOCK_FILE)
+        self.lock, self.npm_index = self._load_lock()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}, {}
+        return manifest.get("modules", {}), manifest.get("load", {})
+
+    def _save_manifest(self) -> None:
+        write_file_atomic(
+            self.manifest_path,
+            json.dumps(
+                {
+                    "version": MANIFEST_VERSION,
+                    "modules": self.manifest,
+                    "load": self.load_lists,
+                },
+                indent=2,
+            ),
+        )
+
+    def _build_load_lists(self) -> dict:
+        """Group the installed configured modules by platform signature"""
+        load_lists = {}
+        for module in self.modules:
+            entry = self.manifest.get(module_key(module))
+            if not entry:
+                continue
+            load_list = load_lists.setdefault(
+                module.platform.lower(), {"modulePath": [], "moduleArgs": []}
+            )
+            load_list["modulePath"].append(entry["path"])
+            load_list["moduleArgs"].append(
+                utils.split_by_semicolon(module.args) if module.args else []
+            )
+        return load_lists
+
+    def _update_load_lists(self) -> None:
+        load_lists = self._build_load_lists()
+        if load_lists != self.load_lists:
+            self.load_lists = load_lists
+            self._save_manifest()
+
+    def load_list(self, signature: str):
+        """Module paths and args to load on a platform, from the installed manifest"""
+        load_list = self.load_lists.get(signature.lower())
+        if not load_list:
+            return [], None
+        module_args = load_list["moduleArgs"]
+        return list(load_list["modulePath"]), module_args if any(module_args) else None
+
+    def _load_lock(self):
+        try:
+            with open(self.lock_path) as f:
+                lock = json.load(f)
+        except (OSError, ValueError):
+            return {}, {}
+        if lock.get("version") != LOCK_VERSION:
+            return {}, {}
+        return lock.get("modules", {}), lock.get("node_modules", {})
+
+    def _save_lock(self) -> None:
+        write_file_atomic(
+            self.lock_path,
+            json.dumps(
+                {
+                    "version": LOCK_VERSION,
+                    "modules": self.lock,
+                    "node_modules": self.npm_index,
+                },
+                indent=2,
+            ),
+        )
+
+    def _package_folder(self, package_name: str):
+        """Look a package up in the node_modules index, rescanning it when stale"""
+        if utils.mtimes_changed(self.npm_index.get("mtimes")):
+            packages, mtimes = utils.index_node_modules(
+                f"{self.state_dir_path}/node_modules"
+            )
+            self.npm_index = {"mtimes": mtimes, "packages": packages}
+        return self.npm_index["packages"].get(package_name)
+
+    def is_current(self) -> bool:
+        """Check whether every configured module is already installed"""
+        for module in self.modules:
+            entry = self.manifest.get(module_key(module))
+            if not entry or not os.path.exists(entry["path"]):
+                return False
+        return True
+
+    def install(self, force: bool = False, update: bool = False) -> None:
+        """Load the config and fetch the modules missing from the artifact cache"""
+        self.load_config()
+        if not force and not update and self.is_current():
+            console.print("Modules are up to date")
+        else:
+            if update:
+                self.lock = {}
+            unlocked = [m for m in self.modules if module_key(m) not in self.lock]
+            if unlocked:
+                self.download_module_packages(unlocked)
+            self.extract_modules()
+        self._update_load_lists()
 
     def load_config(self) -> None:
         """Load Redis modules config file"""
+        self.modules = []
         if not os.path.exists(self.cfg_path):
             return
 
@@ -39,89 +184,252 @@ class ModuleLoader:
             except Exception as e:
                 print("Redis modules config file not loaded")
 
-    def download_module_packages(self) -> None:
-        """Download Redis modules npm packages"""
-        for module in self.modules:
-            console.print(f"Downloading npm package: <[cyan]{module.name}[/cyan]>")
-            utils.run_npm(
-                self.state_dir_path,
-                "install",
-                f"--prefix {self.state_dir_path}",
-                f"@{module.name}",
-            )
+    def download_module_packages(self, modules=None) -> None:
+        """Download Redis modules npm packages in a single npm install"""
+        packages = []
+        for module in modules if modules is not None else self.modules:
+            package = f"@{module.name}" if "/" in module.name else module.name
+            if module.version:
+                package += f"@{module.version}"
+            if package not in packages:
+                packages.append(package)
+        if not packages:
+            return
+        console.print(f"Downloading npm packages: <[cyan]{' '.join(packages)}[/cyan]>")
+        if utils.run_npm(self.state_dir_path, "install", packages):
+            console.print("[red]npm install of the module packages failed[/red]")
 
-    def extract_modules(self) -> None:
-        """Download Redis modules based on npm package metadata"""
+    def _resolve_target(self, module: Module):
+        """Find the download url of a module for its platform in the npm metadata"""
+        # scoped modules are configured without the leading @
+        package_name = f"@{module.name}" if "/" in module.name else module.name
 
-        package_path = (
-            f"{self.state_dir_path}/{StateDir.MOD.value}/{MODULE_PACKAGE_DEFAULT_NAME}"
-        )
-        for module in self.modules:
-            if "/" in module.name:
-                package_name = module.name.split("/")[-1]
+        # locate npm package folder based on config file
+        package_folder = self._package_folder(package_name)
+        if not package_folder:
+            console.print(f"[red]npm package {package_name} is not installed[/red]")
+            return None
 
-            # locate npm package folder based on config file
-            package_folder = utils.find_folder(
-                package_name, f"{self.state_dir_path}/node_modules"
-            )
+        with open(f"{package_folder}/{NPM_METADATA_FILE}") as f:
+            module_data = json.load(f)
 
-            with open(f"{package_folder}/{NPM_METADATA_FILE}") as f:
-                module_data = json.load(f)
-
-                target_platform = None
-                module_platforms = module_data["platform"]
-                console.print("Available versions:")
-                for platform in module_platforms:
-                    print(platform)
-                    if module.platform.lower() == platform.lower():
-                        target_platform = platform
-
-                if not target_platform:
-                    continue
-
-                target_module = module_data["platform"][target_platform]
-                # download module by s3 link
-                console.print(f"Downloading [cyan]{target_platform}[/cyan] version.")
-                response = requests.get(target_module["path"])
-                with open(
-                    package_path,
-                    "wb",
-                ) as f:
-                    f.write(response.content)
-
-                # extract module .so file from archive
-                console.print(f"Extracting files")
-                with zipfile.ZipFile(
-                    package_path,
-                    "r",
-                ) as zip_ref:
-                    zip_ref.extract(
-                        MODULE_METADATA_FILE,
-                        path=f"{self.state_dir_path}/{StateDir.MOD.value}/{module.platform.lower()}",
-                    )
+        target_platform = None
+        module_platforms = module_data["platform"]
+        console.print("Available versions:")
+        for platform in module_platforms:
+            print(platform)
+            if module.platform.lower() == platform.lower():
+                target_platform = platform
 
-                    # get module file name from the module metadata file
-                    with open(
-                        f"{self.state_dir_path}/{StateDir.MOD.value}/{module.platform.lower()}/{MODULE_METADATA_FILE}"
-                    ) as f:
-                        data = json.load(f)
-                        module_file = data["module_file"]
+        if not target_platform:
+            return None
+        return module_data["platform"][target_platform]
 
-                    zip_ref.extract(
-                        module_file,
-                        path=f"{self.state_dir_path}/{StateDir.MOD.value}/{module.platform.lower()}",
+    def _download(self, session, url: str, path: str, sha256=None) -> str:
+        """Stream url into path, resuming partial downloads and retrying on errors"""
+        # partial files are keyed by url so another artifact never resumes them
+        part_path = f"{path}.{hashlib.sha256(url.encode()).hexdigest()[:16]}.part"
+        validator_path = part_path + ".validator"
+        for stale in glob.glob(glob.escape(path) + ".*.part*"):
+            if stale not in (part_path, validator_path):
+                os.remove(stale)
+        error = None
+        for attempt in range(DOWNLOAD_RETRIES):
+            if attempt:
+                time.sleep(min(2**attempt, 10) * 0.5)
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                # resume only while the server still has the same bytes
+                if os.path.exists(validator_path):
+                    with open(validator_path) as f:
+                        headers["If-Range"] = f.read()
+            try:
+                with session.get(
+                    url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+                ) as response:
+                    if offset and response.status_code == 416:
+                        # the partial file may be complete, trust it only when it
+                        # has the size the server reports or a checksum follows
+                        total = response.headers.get("Content-Range", "")
+                        if not sha256 and total.rpartition("/")[2] != str(offset):
+                            os.remove(part_path)
+                            if os.path.exists(validator_path):
+                                os.remove(validator_path)
+                            error = ValueError(f"Stale partial download of {url}")
+                            continue
+                    else:
+                        response.raise_for_status()
+                        # servers ignoring the range send the whole file again
+                        resumed = response.status_code == 206
+                        if not resumed:
+                            self._save_validator(validator_path, response)
+                        with open(part_path, "ab" if resumed else "wb") as f:
+                            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                                f.write(chunk)
+            except (requests.RequestException, OSError) as e:
+                error = e
+                continue
+
+            checksum_ok = not sha256 or file_sha256(part_path) == sha256.lower()
+            if os.path.exists(validator_path):
+                os.remove(validator_path)
+            if not checksum_ok:
+                os.remove(part_path)
+                error = ValueError(f"Checksum mismatch for {url}")
+                continue
+            os.replace(part_path, path)
+            return path
+        raise error
+
+    @staticmethod
+    def _save_validator(validator_path: str, response) -> None:
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        if validator:
+            with open(validator_path, "w") as f:
+                f.write(validator)
+        elif os.path.exists(validator_path):
+            os.remove(validator_path)
+
+    def _download_all(self, targets) -> list:
+        """Download module packages concurrently, one http session per worker"""
+        download_dir = f"{self.state_dir_path}/{StateDir.MOD.value}/{DOWNLOAD_DIR}"
+        os.makedirs(download_dir, exist_ok=True)
+        workers = max(1, min(self.download_workers, len(targets)))
+        # requests sessions are not thread safe, every worker keeps its own
+        local = threading.local()
+        sessions = []
+
+        def download(url, path, sha256):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+                sessions.append(local.session)
+            return self._download(local.session, url, path, sha256)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for module, target_module in targets:
+                    package_path = "{}/{}-{}.zip".format(
+                        download_dir,
+                        module.name.replace("/", "_"),
+                        module.platform.lower(),
                     )
+                    console.print(
+                        f"Downloading [cyan]{module.platform}[/cyan] version of <[cyan]{module.name}[/cyan]>."
+                    )
+                    futures.append(
+                        executor.submit(
+                            download,
+                            target_module["path"],
+                            package_path,
+                            target_module.get("sha256"),
+                        )
+                    )
+                return [future.result() for future in futures]
+        finally:
+            for session in sessions:
+                session.close()
+
+    def _find_identical(self, info: zipfile.ZipInfo, module_path: str):
+        """Find an installed module file that may hold the same bytes as a zip member"""
+        for entry in self.manifest.values():
+            if (
+                entry.get("size") == info.file_size
+                and entry.get("crc32") == info.CRC
+                and entry["path"] != module_path
+                and os.path.exists(entry["path"])
+            ):
+                return entry
+        return None
+
+    def _install_module_file(
+        self, zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo, module_path: str
+    ) -> str:
+        """Write a zip member to module_path in one pass, hard-linking identical files"""
+        os.makedirs(os.path.dirname(module_path), exist_ok=True)
+        tmp_path = f"{module_path}.{os.getpid()}.tmp"
+
+        identical = self._find_identical(info, module_path)
+        if identical:
+            digest = hashlib.sha256()
+            with zip_ref.open(info) as src:
+                for chunk in iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() == identical["sha256"]:
+                if os.path.exists(module_path) and os.path.samefile(
+                    identical["path"], module_path
+                ):
+                    return identical["sha256"]
+                try:
+                    os.link(identical["path"], tmp_path)
+                    os.replace(tmp_path, module_path)
+                    return identical["sha256"]
+                except OSError:
+                    pass  # different filesystem, write a copy instead
+
+        digest = hashlib.sha256()
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777)
+        try:
+            os.fchmod(fd, 0o777)
+            with os.fdopen(fd, "wb") as dst, zip_ref.open(info) as src:
+                for chunk in iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            os.replace(tmp_path, module_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest.hexdigest()
+
+    def extract_modules(self) -> None:
+        """Download Redis modules based on npm package metadata"""
+        targets = []
+        for module in self.modules:
+            locked = self.lock.get(module_key(module))
+            if locked:
+                target_module = {"path": locked["url"], "sha256": locked["sha256"]}
+            else:
+                target_module = self._resolve_target(module)
+            if target_module:
+                targets.append((module, target_module))
+        if not targets:
+            return
+
+        package_paths = self._download_all(targets)
+        for (module, target_module), package_path in zip(targets, package_paths):
+            # pin the resolved artifact so later runs skip the npm resolution
+            self.lock[module_key(module)] = {
+                "name": module.name,
+                "version": module.version,
+                "platform": module.platform,
+                "url": target_module["path"],
+                "sha256": target_module.get("sha256") or file_sha256(package_path),
+            }
 
-                # remove module metadata file
-                os.remove(
-                    f"{self.state_dir_path}/{StateDir.MOD.value}/{module.platform.lower()}/{MODULE_METADATA_FILE}"
-                )
+            # read the module metadata and stream the .so straight out of the archive
+            console.print(f"Extracting files")
+            with zipfile.ZipFile(package_path, "r") as zip_ref:
+                data = json.loads(zip_ref.read(MODULE_METADATA_FILE))
+                module_file = data["module_file"]
+                module_path = f"{self.state_dir_path}/{StateDir.MOD.value}/{module.platform.lower()}/{module_file}"
+                info = zip_ref.getinfo(module_file)
+                module_sha256 = self._install_module_file(zip_ref, info, module_path)
 
-                # remove tmp archive
-                os.remove(package_path)
+            # remove tmp archive
+            os.remove(package_path)
 
-                # make modules file executable
-                os.chmod(
-                    f"{self.state_dir_path}/{StateDir.MOD.value}/{module.platform.lower()}/{module_file}",
-                    0o777,
-                )
+            self.manifest[module_key(module)] = {
+                "name": module.name,
+                "version": module.version,
+                "platform": module.platform,
+                "path": module_path,
+                "sha256": module_sha256,
+                "size": info.file_size,
+                "crc32": info.CRC,
+                "url": target_module["path"],
+            }
+        self._save_manifest()
+        self._save_lock()
@@ -1,9 +1,13 @@
+import json
 import os
 import platform
 import re
 import tempfile
+import threading
 from subprocess import PIPE, Popen
 
+from redisero.state import write_file_atomic
+
 DEBIAN_VERSIONS = {
     "buzz": "1.1",
     "rex": "1.2",
@@ -452,3 +456,63 @@ class Platform:
         else:
             nick = ""
         print(os + " " + self.os_ver + nick + " " + self.arch)
+
+
+# ----------------------------------------------------------------------------------------------
+
+PLATFORM_CACHE_FILE = "platform.json"
+PLATFORM_RELEASE_FILES = ["/etc/os-release", "/etc/redhat-release", "/etc/system-release"]
+
+_current_platform = None
+_current_platform_lock = threading.Lock()
+
+
+def _release_stamp():
+    """Identity of the files platform detection reads, to invalidate a cached result"""
+    stamp = [platform.system(), platform.machine(), platform.release()]
+    for path in PLATFORM_RELEASE_FILES:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stamp.append(f"{path}:{st.st_mtime_ns}:{st.st_size}")
+    return stamp
+
+
+def _load_cached_platform(cache_path, stamp):
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("stamp") != stamp:
+        return None
+    plat = Platform.__new__(Platform)
+    plat.__dict__.update(cached["platform"])
+    return plat
+
+
+def _save_cached_platform(cache_path, stamp, plat):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_file_atomic(
+            cache_path, json.dumps({"stamp": stamp, "platform": vars(plat)})
+        )
+    except OSError:
+        pass  # the cache is an optimization only
+
+
+def current_platform(cacheDir=None):
+    """Process-wide Platform of this host, optionally persisted in cacheDir"""
+    global _current_platform
+    with _current_platform_lock:
+        if _current_platform is None:
+            stamp = _release_stamp()
+            cache_path = cacheDir and os.path.join(cacheDir, PLATFORM_CACHE_FILE)
+            plat = cache_path and _load_cached_platform(cache_path, stamp)
+            if not plat:
+                plat = Platform()
+                if cache_path:
+                    _save_cached_platform(cache_path, stamp, plat)
+            _current_platform = plat
+        return _current_platform
@@ -1,9 +1,10 @@
+import os
 import typing
-from enum import Enum
 
 import pydantic
 
 import redisero.os_platform
+from redisero.state import StateDir  # noqa: F401
 
 
 class Defaults:
@@ -54,18 +55,85 @@ class Defaults:
         return kwargs
 
 
-# State dir structure
-class StateDir(Enum):
-    BIN = "bin"
-    CFG = "cfg"
-    MOD = "mod"
-    LOG = "log"
-    RDB = "rdb"
-    RUN = "run"
+PROFILES_FILE = "profiles.yml"
+LAZYFREE = {
+    "lazyfree-lazy-eviction": "yes",
+    "lazyfree-lazy-expire": "yes",
+    "lazyfree-lazy-server-del": "yes",
+    "lazyfree-lazy-user-del": "yes",
+}
+# built-in server settings, user profiles live in profiles.yml next to modules.yml
+PROFILES = {
+    "throughput": {
+        "save": "",
+        "appendonly": "no",
+        "hz": "10",
+        "io-threads": "4",
+        "activedefrag": "no",
+        "tcp-backlog": "65535",
+        **LAZYFREE,
+    },
+    "latency": {
+        "save": "",
+        "appendonly": "no",
+        "hz": "100",
+        "dynamic-hz": "no",
+        "activedefrag": "no",
+        "tcp-backlog": "511",
+        **LAZYFREE,
+    },
+    "durable": {
+        "save": "900 1 300 10 60 10000",
+        "appendonly": "yes",
+        "appendfsync": "always",
+        "aof-use-rdb-preamble": "yes",
+    },
+}
 
-    @classmethod
-    def list(cls):
-        return list(map(lambda c: c.value, cls))
+
+def _config_value(value):
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    return "" if value is None else str(value)
+
+
+def load_profile(name, cfgDir=None):
+    """Resolve a named profile into {"name", "settings"}
+
+    User profiles are read from profiles.yml in cfgDir, a mapping of profile
+    names to server settings. They take precedence over the built-in ones and
+    may build on another profile with an "extends" key.
+    """
+    profiles = {}
+    path = os.path.join(cfgDir, PROFILES_FILE) if cfgDir else None
+    if path and os.path.exists(path):
+        import yaml
+
+        with open(path) as f:
+            try:
+                profiles = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError("Invalid %s: %s" % (path, e))
+        if not isinstance(profiles, dict):
+            raise ValueError("Invalid %s: expected a mapping of profiles" % path)
+
+    settings = {}
+    seen = []
+    while name not in seen:
+        seen.append(name)
+        profile = profiles.get(name, PROFILES.get(name))
+        if profile is None:
+            raise ValueError("Unknown profile: %s" % name)
+        profile = dict(profile)
+        parent = profile.pop("extends", None)
+        settings = {**profile, **settings}
+        if parent is None:
+            break
+        name = parent
+    return {
+        "name": seen[0],
+        "settings": {option: _config_value(v) for option, v in settings.items()},
+    }
 
 
 # Module model
@@ -73,10 +141,11 @@ class Module(pydantic.BaseModel):
     name: str
     version: typing.Optional[str] = None
     platform: typing.Optional[str] = None
+    args: typing.Optional[str] = None
 
     @pydantic.validator("platform", pre=True, always=True)
     def default_platform(cls, v):
         if not v:
-            platform = redisero.os_platform.Platform()
+            platform = redisero.os_platform.current_platform()
             return f"{platform.osnick}-{platform.arch}"
         return v
@@ -0,0 +1,175 @@
+import fcntl
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from enum import Enum
+
+# bump whenever the layout of the state file changes incompatibly
+STATE_VERSION = 1
+STATE_SUFFIX = ".json"
+LOCK_SUFFIX = ".lock"
+DEFAULT_CLUSTER = "default"
+CLUSTER_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+# State dir structure
+class StateDir(Enum):
+    BIN = "bin"
+    CFG = "cfg"
+    MOD = "mod"
+    LOG = "log"
+    RDB = "rdb"
+    RUN = "run"
+    TPL = "tpl"
+
+    @classmethod
+    def list(cls):
+        return list(map(lambda c: c.value, cls))
+
+
+def state_path(run_dir, name):
+    """Run state file of a named cluster"""
+    return os.path.join(run_dir, name + STATE_SUFFIX)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path across processes"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cluster_lock(run_dir, name):
+    """Serialize starting and stopping of a named cluster"""
+    return file_lock(os.path.join(run_dir, name + LOCK_SUFFIX))
+
+
+def list_clusters(run_dir):
+    """Names and run states of the clusters recorded in run_dir"""
+    try:
+        filenames = sorted(os.listdir(run_dir))
+    except OSError:
+        return []
+    clusters = []
+    for filename in filenames:
+        if filename.startswith(".") or not filename.endswith(STATE_SUFFIX):
+            continue
+        try:
+            state = load_state(os.path.join(run_dir, filename))
+        except (OSError, ValueError):
+            continue
+        clusters.append((filename[: -len(STATE_SUFFIX)], state))
+    return clusters
+
+
+def pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_file_atomic(path, data, mode="w"):
+    """Write a file through a temporary sibling and rename it into place"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def save_state(path, state):
+    """Atomically write the run state of a cluster"""
+    write_file_atomic(path, json.dumps(dict(state, version=STATE_VERSION), indent=2))
+
+
+def load_state(path):
+    """Read the run state of a cluster, refusing unknown layouts"""
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("version") != STATE_VERSION:
+        raise ValueError(
+            "Unsupported run state version %s in %s" % (state.get("version"), path)
+        )
+    return state
+
+
+def format_slot_ranges(ranges):
+    return ",".join(
+        str(start) if start == end else "%d-%d" % (start, end) for start, end in ranges
+    )
+
+
+def format_cpu_list(cpus):
+    """Compact cpu numbers into a sysfs style list such as 0-3,8"""
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] + 1 == cpu:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return format_slot_ranges(ranges)
+
+
+def print_state(state, write=print):
+    """Describe a cluster straight from its run state"""
+    write("Info:")
+    if state.get("name"):
+        write("\tname:%s" % state["name"])
+    write("\tshards count:%d" % len(state["shards"]))
+    if state.get("ephemeralDir"):
+        write("\tephemeral state dir:%s" % state["ephemeralDir"])
+    if state.get("placement") and state["placement"] != "none":
+        write("\tcpu placement:%s" % state["placement"])
+    shard = state["shards"][0] if state["shards"] else {}
+    profile = shard.get("config", {}).get("profile")
+    if profile:
+        # the settings passed to the servers, the profile ones until started
+        applied = shard.get("appliedProfile") or {"settings": profile["settings"]}
+        write("\tprofile:%s" % profile["name"])
+        for option, value in applied["settings"].items():
+            write("\t\t%s %s" % (option, value if value else '""'))
+        if applied.get("skipped"):
+            write("\t\tnot supported, skipped: %s" % ", ".join(applied["skipped"]))
+    if state.get("modulePath"):
+        write("\tzip module path:%s" % state["modulePath"])
+    if state.get("moduleArgs"):
+        write("\tmodule args:%s" % state["moduleArgs"])
+    for i, shard in enumerate(state["shards"]):
+        write("Shard: %d" % (i + 1))
+        if shard.get("slots"):
+            write("\tslots: %s" % format_slot_ranges(shard["slots"]))
+        if shard["config"].get("numaNode") is not None:
+            write("\tnuma node: %d" % shard["config"]["numaNode"])
+        if shard["config"].get("ioThreads"):
+            write("\tio threads: %d" % shard["config"]["ioThreads"])
+        for server in shard["servers"]:
+            write("\t%s:" % server["role"])
+            write("\t\tpid: %s" % server["pid"])
+            if server.get("cpus"):
+                write("\t\tcpus: %s" % format_cpu_list(server["cpus"]))
+            if server["port"] > -1:
+                write("\t\tport: %d" % server["port"])
+            if server.get("unixSocket"):
+                write("\t\tunix_socket_path: %s" % server["unixSocket"])
+            write("\t\tbinary path: %s" % shard["config"]["redisBinaryPath"])
+            write("\t\tserver id: %d" % server["serverId"])
+            if server.get("logFile"):
+                write("\t\tlog file: %s" % server["logFile"])
+            write("\t\tdb file: %s" % server["rdbFile"])
@@ -1,19 +1,26 @@
 import copy
 import errno
 import fcntl
+import glob
 import itertools
 import json
 import os
 import random
 import re
+import shutil
 import socket
 import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+from typing import List
 
 import redis
 
+from redisero.state import pid_alive, write_file_atomic
+
 
 def wait_for_conn(conn, retries=20, command="PING", shouldBe=True):
     """Wait until a given Redis connection is ready"""
@@ -35,6 +42,185 @@ def wait_for_conn(conn, retries=20, command="PING", shouldBe=True):
     raise Exception("Cannot establish connection %s: %s" % (conn, err1))
 
 
+SERVER_READY_MARKERS = ("Ready to accept connections",)
+SERVER_FATAL_MARKERS = (
+    "FATAL CONFIG FILE ERROR",
+    "Can't load module",
+    "server aborting",
+    "Fatal error",
+    "REDIS BUG REPORT START",
+)
+
+
+def wait_for_server(proc, conn, logPath=None, logOffset=0, timeout=20):
+    """Wait until a redis-server child is ready, has exited or logged a fatal error
+
+    Returns a (status, lines) tuple, status being one of "ready", "exited",
+    "fatal" or "timeout" and lines the log lines seen while waiting.
+    """
+    deadline = time.time() + timeout
+    nextProbe = 0
+    log = None
+    pending = ""
+    seen = []
+    try:
+        while time.time() < deadline:
+            exited = proc.poll() is not None
+            if log is None and logPath and os.path.exists(logPath):
+                log = open(logPath, errors="replace")
+                log.seek(logOffset)
+            if log is not None:
+                lines = (pending + log.read()).split("\n")
+                pending = lines.pop()
+                for line in lines:
+                    seen.append(line)
+                    if any(marker in line for marker in SERVER_FATAL_MARKERS):
+                        return "fatal", seen
+                    if any(marker in line for marker in SERVER_READY_MARKERS):
+                        return "ready", seen
+            if exited:
+                return "exited", seen
+            # without a log file readiness can only be observed on the socket
+            if not logPath and time.time() >= nextProbe:
+                if _accepts_connections(conn):
+                    return "ready", seen
+                nextProbe = time.time() + 0.1
+            time.sleep(0.01)
+    finally:
+        if log is not None:
+            log.close()
+    return "timeout", seen
+
+
+def _accepts_connections(conn):
+    kwargs = conn.connection_pool.connection_kwargs
+    try:
+        if "path" in kwargs:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(0.1)
+            s.connect(kwargs["path"])
+        else:
+            address = (kwargs.get("host", "localhost"), kwargs.get("port", 6379))
+            s = socket.create_connection(address, timeout=0.1)
+        s.close()
+        return True
+    except OSError:
+        return False
+
+
+def analyse_server_log(lines):
+    """Return the REDIS BUG REPORT section (up to the INFO OUTPUT) of a server log"""
+    report = []
+    bug_report_found = False
+    for line in lines:
+        if "REDIS BUG REPORT START" in line:
+            bug_report_found = True
+        if "------ INFO OUTPUT ------" in line:
+            break
+        if bug_report_found is True:
+            report.append(line.rstrip())
+    return report
+
+
+BINARY_PROBE_FILE = "redis-binaries.json"
+# bump whenever the content of a probe changes, older cached probes are redone
+BINARY_PROBE_VERSION = 2
+
+_binary_probes = {}
+_binary_probes_lock = threading.Lock()
+
+
+def probe_redis_binary(binaryPath, cacheDir=None):
+    """Return the version, build flags and supported options of a redis-server
+
+    Probes are keyed by the resolved binary path, its mtime and size. They are
+    memoized per process and, when cacheDir is given, persisted there so that
+    later runs do not have to fork the binary at all.
+    """
+    path = os.path.realpath(shutil.which(binaryPath) or binaryPath)
+    st = os.stat(path)
+    key = "%s:%d:%d" % (path, st.st_mtime_ns, st.st_size)
+    with _binary_probes_lock:
+        if key in _binary_probes:
+            return _binary_probes[key]
+
+        cacheFile = os.path.join(cacheDir, BINARY_PROBE_FILE) if cacheDir else None
+        cache = {}
+        if cacheFile and os.path.exists(cacheFile):
+            try:
+                with open(cacheFile) as f:
+                    cache = json.load(f)
+            except ValueError:
+                cache = {}
+
+        probe = cache.get(key)
+        if probe is None or probe.get("probeVersion") != BINARY_PROBE_VERSION:
+            probe = _run_binary_probe(path)
+            if cacheFile:
+                # drop stale probes of a rebuilt binary
+                cache = {k: v for k, v in cache.items() if v.get("path") != path}
+                cache[key] = probe
+                os.makedirs(cacheDir, exist_ok=True)
+                write_file_atomic(cacheFile, json.dumps(cache, indent=2))
+        _binary_probes[key] = probe
+        return probe
+
+
+def _run_binary_probe(path):
+    res = subprocess.run([path, "--version"], capture_output=True)
+    if res.returncode != 0:
+        raise Exception("Could not extract Redis version")
+    # e.g. Redis server v=7.2.4 sha=00000000:0 malloc=jemalloc-5.3.0 bits=64 build=...
+    out = res.stdout.decode("utf-8").strip()
+    flags = dict(token.split("=", 1) for token in out.split() if "=" in token)
+    v = flags.get("v", "0.0.0").split(".")
+    version = int(v[0]) * 10000 + int(v[1]) * 100 + int(v[2])
+    return {
+        "probeVersion": BINARY_PROBE_VERSION,
+        "path": path,
+        "version": version,
+        "version_str": flags.get("v"),
+        "build": flags,
+        "options": _probe_config_options(path),
+    }
+
+
+def _probe_config_options(path, timeout=10):
+    """Ask a short-lived server started from the binary which config options it has"""
+    with tempfile.TemporaryDirectory(prefix="redisero-probe-") as tmp:
+        socketPath = os.path.join(tmp, "probe.sock")
+        proc = subprocess.Popen(
+            [path, "--port", "0", "--unixsocket", socketPath, "--dir", tmp]
+            + ["--save", "", "--appendonly", "no", "--logfile", ""],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            con = redis.Redis(unix_socket_path=socketPath, decode_responses=True)
+            deadline = time.time() + timeout
+            while True:
+                if proc.poll() is not None:
+                    raise Exception(
+                        "Redis %s exited with code %d while probing its config"
+                        % (path, proc.returncode)
+                    )
+                try:
+                    return sorted(con.config_get("*"))
+                except redis.ConnectionError:
+                    if time.time() > deadline:
+                        raise Exception("Redis %s did not start for probing" % path)
+                    time.sleep(0.05)
+        finally:
+            proc.kill()
+            proc.wait()
+
+
+def binary_supports(probe, option):
+    """Check whether a probed server has a config option"""
+    return option in probe["options"]
+
+
 def fix_modules(modules, defaultModules=None):
     # modules is one of the following:
     # None
@@ -157,92 +343,278 @@ def fix_modulesArgs(modules, modulesArgs, defaultArgs=None, haveSeqs=True):
     return modulesArgs
 
 
-def _check_alive(pid):
+PORT_LEASE_FILE = "/tmp/redisero_ports.lease"
+PORT_RANGE = (10000, 20000)
+# cluster bus ports live at a fixed offset from the data port
+CLUSTER_BUS_PORT_OFFSET = 10000
+
+
+def _port_is_free(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
     try:
-        os.kill(pid, 0)
+        s.bind(("", port))
         return True
     except OSError as e:
-        if e.errno == errno.EPERM:
-            return True
-        return False
+        if e.errno in (errno.EADDRINUSE, errno.EADDRNOTAVAIL):
+            return False
+        raise
+    finally:
+        s.close()
 
 
-def register_port(port):
-    fp = open("/tmp/redisero_portfile.lock", "a+")
-    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
-    fp.seek(0, 2)  # seek from end
-    if fp.tell() == 0:
-        entries = {}
-    else:
-        fp.seek(0, 0)
-        entries = json.load(fp)
-    # remove not responsive processes
-    entries = {p: pid for p, pid in entries.items() if _check_alive(pid)}
+def _read_leases(fp):
+    # one lease per line: <owner> <first port> <count> <pid>[,<pid>...]
+    fp.seek(0, 0)
+    leases = []
+    for line in fp:
+        try:
+            owner, start, count, pids = line.split()
+            leases.append([owner, int(start), int(count), list(map(int, pids.split(",")))])
+        except ValueError:
+            continue
+    return leases
 
-    if str(port) in entries:
-        ret = False
-    else:
-        entries[str(port)] = os.getpid()
-        ret = True
 
+def _write_leases(fp, leases):
     fp.seek(0, 0)
     fp.truncate()
-    json.dump(entries, fp)
-    fp.close()
+    fp.write(
+        "".join(
+            "%s %d %d %s\n" % (owner, start, count, ",".join(map(str, pids)))
+            for owner, start, count, pids in leases
+        )
+    )
+
+
+def _update_leases(fn):
+    with open(PORT_LEASE_FILE, "a+") as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        # leases whose processes are all gone are free again
+        leases = [l for l in _read_leases(fp) if any(map(pid_alive, l[3]))]
+        ret = fn(leases)
+        _write_leases(fp, leases)
     return ret
 
 
-def get_random_port():
-    for _ in range(10000):
-        p = random.randint(10000, 20000)
-        # Try to open and bind the socket
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
-        try:
-            s.bind(("", p))
-            s.close()
-            if not register_port(p):
-                continue
-            return p
-        except Exception as e:
-            if hasattr(e, "errno") and e.errno in (
-                errno.EADDRINUSE,
-                errno.EADDRNOTAVAIL,
-            ):
-                pass
-            else:
-                raise e
+def lease_ports(count, owner):
+    """Lease a block of count consecutive free ports in one locked transaction
+
+    The lease stays valid while any of its pids is alive, initially the
+    calling process; see bind_port_lease and release_ports.
+    """
+
+    def lease(leases):
+        low, high = PORT_RANGE
+        for _ in range(1000):
+            first = random.randint(low, high - count + 1)
+            if _take_ports(leases, first, count, owner):
+                return list(range(first, first + count))
+        raise Exception("Could not find %d open ports to listen on!" % count)
+
+    return _update_leases(lease)
+
 
-    raise Exception("Could not find open port to listen on!")
+def reserve_ports(first, count, owner):
+    """Lease the fixed block of count ports starting at first, if it is free
 
+    Returns False when another lease holds one of the ports or one of them is
+    in use, so fixed port clusters and leased ones never overlap.
+    """
+    return _update_leases(lambda leases: _take_ports(leases, first, count, owner))
 
-def find_folder(name, path):
-    for root, dirs, files in os.walk(path):
-        if name in dirs:
-            return os.path.join(root, name)
-    return None
 
+def _take_ports(leases, first, count, owner):
+    ports = range(first, first + count)
+    for _, start, n, _ in leases:
+        if start < ports.stop and first < start + n:
+            return False
+    if not all(
+        _port_is_free(p) and _port_is_free(p + CLUSTER_BUS_PORT_OFFSET) for p in ports
+    ):
+        return False
+    leases.append([owner, first, count, [os.getpid()]])
+    return True
+
+
+def bind_port_lease(owner, pids):
+    """Tie the ports leased by owner to the lifetime of the given processes"""
+
+    def bind(leases):
+        for l in leases:
+            if l[0] == owner:
+                l[3] = list(pids) or l[3]
+
+    _update_leases(bind)
+
+
+def release_ports(owner):
+    """Free all the ports leased by owner"""
+
+    def release(leases):
+        leases[:] = [l for l in leases if l[0] != owner]
+
+    _update_leases(release)
+
+
+CPU_SYSFS_PATH = "/sys/devices/system"
+
+
+def parse_cpu_list(value):
+    """Expand a sysfs cpu list such as 0-3,8 into cpu numbers"""
+    cpus = []
+    for part in filter(None, value.strip().split(",")):
+        start, _, end = part.partition("-")
+        cpus += range(int(start), int(end or start) + 1)
+    return cpus
+
+
+def _read_cpu_list(path):
+    try:
+        with open(path) as f:
+            return parse_cpu_list(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_topology():
+    """CPUs this process may use grouped by NUMA node, physical cores first
+
+    Hyperthread siblings come after the first thread of every core of the
+    node, so taking cpus from the front of a node spreads over real cores.
+    """
+    allowed = os.sched_getaffinity(0)
+    node_paths = glob.glob(f"{CPU_SYSFS_PATH}/node/node[0-9]*/cpulist")
+    node_paths.sort(key=lambda p: int(re.search(r"node(\d+)/cpulist$", p).group(1)))
+    nodes = []
+    for path in node_paths:
+        cpus = [cpu for cpu in _read_cpu_list(path) or [] if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes = [sorted(allowed)]
+
+    def thread_index(cpu):
+        siblings = _read_cpu_list(
+            f"{CPU_SYSFS_PATH}/cpu/cpu{cpu}/topology/thread_siblings_list"
+        )
+        return siblings.index(cpu) if siblings and cpu in siblings else 0
 
-def list_files(path):
-    for root, directories, files in os.walk(path):
+    return [sorted(cpus, key=lambda cpu: (thread_index(cpu), cpu)) for cpus in nodes]
+
+
+def set_process_affinity(pid, cpus):
+    """Pin every thread of a running process to cpus"""
+    try:
+        tids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        tids = [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            pass  # the thread exited meanwhile
+
+
+RAM_FILESYSTEMS = ("tmpfs", "ramfs")
+
+
+def _mount_fstype(path):
+    """Filesystem type of the mount holding path"""
+    path = os.path.realpath(path)
+    mount_point, fstype = "", None
+    try:
+        with open("/proc/self/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1].replace("\\040", " ")
+                inside = path == mnt or path.startswith(mnt.rstrip("/") + "/")
+                if inside and len(mnt) >= len(mount_point):
+                    mount_point, fstype = mnt, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def ephemeral_root():
+    """A writable RAM backed directory for throwaway server state"""
+    candidates = ["/dev/shm", "/run/user/%d" % os.getuid(), tempfile.gettempdir()]
+    for path in candidates:
+        if (
+            os.path.isdir(path)
+            and os.access(path, os.W_OK)
+            and _mount_fstype(path) in RAM_FILESYSTEMS
+        ):
+            return path
+    raise Exception("No writable tmpfs found for ephemeral state")
+
+
+def dir_size(path):
+    """Total size in bytes of the files below path"""
+    total = 0
+    for root, _, files in os.walk(path):
         for filename in files:
-            yield os.path.join(root, filename)
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def index_node_modules(path):
+    """Map the packages installed in a node_modules folder to their folders"""
+    packages, mtimes = {}, {}
+    try:
+        mtimes[path] = os.stat(path).st_mtime_ns
+        entries = list(os.scandir(path))
+    except OSError:
+        return packages, {}
+    for entry in entries:
+        if entry.name.startswith(".") or not entry.is_dir():
+            continue
+        if entry.name.startswith("@"):
+            # scoped packages live one level down, in node_modules/@org/name
+            mtimes[entry.path] = entry.stat().st_mtime_ns
+            for scoped in os.scandir(entry.path):
+                if scoped.is_dir():
+                    packages[f"{entry.name}/{scoped.name}"] = scoped.path
+        else:
+            packages[entry.name] = entry.path
+    return packages, mtimes
+
+
+def mtimes_changed(mtimes):
+    """Check whether any of the recorded folders was modified or removed"""
+    if not mtimes:
+        return True
+    for path, mtime in mtimes.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return True
+        except OSError:
+            return True
+    return False
 
 
 def run_npm(
     pkgdir: str,
     cmd: str,
-    prefix: str,
-    args: str,
+    args: List[str],
     npm_bin: str = "npm",
-):
-    """Run npm command"""
-    command = [npm_bin, cmd, prefix, args]
+) -> int:
+    """Run npm command, printing its output if it fails"""
+    command = [npm_bin, cmd, "--prefix", pkgdir, *args]
 
-    return subprocess.call(
+    result = subprocess.run(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         cwd=pkgdir,
+        text=True,
     )
+    if result.returncode:
+        print(result.stdout)
+    return result.returncode
@@ -0,0 +1,77 @@
+import random
+
+import pytest
+import redis
+
+from redisero import bench
+from redisero.bench import HISTOGRAM_SUB_BITS, LatencyHistogram
+
+
+def test_small_values_are_exact():
+    for value in range(2 << HISTOGRAM_SUB_BITS):
+        assert LatencyHistogram._value(LatencyHistogram._index(value)) == value
+
+
+def test_relative_error_bound():
+    bound = 1.0 / (1 << HISTOGRAM_SUB_BITS)
+    worst = 0.0
+    for value in range(1, 1 << 20):
+        top = LatencyHistogram._value(LatencyHistogram._index(value))
+        assert top >= value
+        worst = max(worst, (top - value) / value)
+    assert worst < bound
+    assert worst < 0.01
+
+
+def test_buckets_are_contiguous():
+    previous = -1
+    for index in range(LatencyHistogram._index(1 << 24)):
+        top = LatencyHistogram._value(index)
+        assert top > previous
+        assert LatencyHistogram._index(previous + 1) == index
+        assert LatencyHistogram._index(top) == index
+        previous = top
+
+
+def test_percentiles_and_merge():
+    rnd = random.Random(7)
+    values = [rnd.randrange(1, 100000) for _ in range(5000)]
+    first, second = LatencyHistogram(), LatencyHistogram()
+    for n, value in enumerate(values):
+        (first if n % 2 else second).record(value)
+    merged = LatencyHistogram(first.to_dict()).merge(LatencyHistogram(second.to_dict()))
+    assert merged.total == len(values)
+    ordered = sorted(values)
+    for percent in (50, 99, 99.9):
+        exact = ordered[int(-(-len(values) * percent // 100)) - 1]
+        assert merged.percentile(percent) == pytest.approx(exact, rel=0.01)
+    assert merged.summary()["max"] >= max(values)
+    assert merged.summary()["max"] == pytest.approx(max(values), rel=0.01)
+
+
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(99) == 0
+    assert histogram.summary()["max"] == 0
+
+
+class FakeShard:
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        self.commands = []
+
+    def execute_command(self, *args):
+        self.commands.append(args[0])
+        if args[0].endswith("CLUSTERREFRESH") and not self.coordinator:
+            raise redis.ResponseError("unknown command '%s'" % args[0])
+        return "OK"
+
+
+@pytest.mark.parametrize("coordinator", [True, False])
+def test_create_index(monkeypatch, coordinator):
+    shards = [FakeShard(coordinator) for _ in range(3)]
+    monkeypatch.setattr(bench, "_shard_clients", lambda targets, host: shards)
+    bench.create_index([], "localhost", "hash", "idx", "doc:")
+    created = [shard.commands.count("FT.CREATE") for shard in shards]
+    dropped = [shard.commands.count("FT.DROPINDEX") for shard in shards]
+    assert created == dropped == ([1, 0, 0] if coordinator else [1, 1, 1])
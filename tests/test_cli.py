@@ -0,0 +1,123 @@
+import types
+
+import pytest
+import redis
+import typer
+
+from redisero import cli
+
+
+def test_check_slots():
+    assert cli._check_slots(3, None, None) == (None, None)
+    assert cli._check_slots(2, "1,3", None) == ([1.0, 3.0], None)
+    assert cli._check_slots(2, None, "0-99,200-16383;100-199") == (
+        None,
+        [[(0, 99), (200, 16383)], [(100, 199)]],
+    )
+
+
+@pytest.mark.parametrize(
+    "weights, ranges",
+    [
+        ("1,x", None),
+        ("1,1,1", None),
+        (None, "0-100;5-16383"),
+        (None, "a-b;0-16383"),
+        (None, "0-16383"),
+    ],
+)
+def test_check_slots_rejects_bad_options(weights, ranges, capsys):
+    with pytest.raises(typer.Exit):
+        cli._check_slots(2, weights, ranges)
+    assert "Invalid slot allocation" in capsys.readouterr().out
+
+
+class FakeShard:
+    masterServerId = 1
+
+    def __init__(self):
+        self.clients = []
+
+    def getPassword(self):
+        return "secret"
+
+    def getClient(self, unix=False, resp3=False):
+        if unix:
+            raise ValueError("Server 1 has no unix socket")
+        raise AssertionError("no client expected")
+
+
+@pytest.fixture
+def running_shard(monkeypatch):
+    shard = FakeShard()
+    monkeypatch.setattr(cli, "_running_state_path", lambda name: "state.json")
+    monkeypatch.setattr(
+        cli, "_load_cluster_env", lambda name: types.SimpleNamespace(shards=[shard])
+    )
+    return shard
+
+
+def test_cli_reports_missing_command_file(running_shard, tmp_path, capsys):
+    missing = str(tmp_path / "missing.txt")
+    with pytest.raises(typer.Exit) as exc:
+        cli.cli("1", None, file=missing, cluster_mode=True, resp3=False, unix=False)
+    assert exc.value.exit_code == 1
+    out = " ".join(capsys.readouterr().out.split())
+    assert f"Cannot read commands from {missing}: No such file" in out
+
+
+def test_cli_reports_missing_unix_socket(running_shard, capsys):
+    with pytest.raises(typer.Exit) as exc:
+        cli.cli("1", ["PING"], file=None, cluster_mode=True, resp3=False, unix=True)
+    assert exc.value.exit_code == 1
+    assert "has no unix socket" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "reply, formatted",
+    [
+        (None, "(nil)"),
+        (True, "OK"),
+        (3, "(integer) 3"),
+        ("bar", "bar"),
+        ([], "(empty array)"),
+        (["a", 1], "1) a\n2) (integer) 1"),
+        ({"k": "v"}, "1) k\n2) v"),
+        (["a", ["b", "c"]], "1) a\n2) 1) b\n   2) c"),
+        (redis.ResponseError("unknown command"), "(error) unknown command"),
+        (
+            redis.exceptions.MovedError("3999 127.0.0.1:6381", status_code="MOVED"),
+            "(error) MOVED 3999 127.0.0.1:6381",
+        ),
+    ],
+)
+def test_format_reply(reply, formatted):
+    assert cli._format_reply(reply) == formatted
+
+
+def test_follow_moved(monkeypatch):
+    class FakeRedis:
+        created = []
+
+        def __init__(self, host, port, **kwargs):
+            self.address = (host, port)
+            self.kwargs = kwargs
+            self.created.append(self)
+
+        def execute_command(self, *args):
+            if self.address == ("127.0.0.1", 6381):
+                return redis.exceptions.MovedError("3999 127.0.0.1:6383")
+            return "bar"
+
+    monkeypatch.setattr(redis, "Redis", FakeRedis)
+    redirects = {}
+    moved = redis.exceptions.MovedError("3999 127.0.0.1:6381")
+    reply = cli._follow_moved(FakeShard(), ["GET", "foo"], moved, redirects, False)
+    assert reply == "bar"
+    assert list(redirects) == [("127.0.0.1", 6381), ("127.0.0.1", 6383)]
+    assert FakeRedis.created[0].kwargs["password"] == "secret"
+
+    # known nodes are reused, replies other than MOVED are left alone
+    assert cli._follow_moved(FakeShard(), ["GET", "foo"], moved, redirects, False) == "bar"
+    assert len(FakeRedis.created) == 2
+    assert cli._follow_moved(FakeShard(), ["GET"], "x", redirects, False) == "x"
@@ -0,0 +1,493 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+import pytest
+
+from redisero import cluster, utils
+from redisero import state as cluster_state
+from redisero.cluster import CLUSTER_SLOTS, ClusterEnv, allocate_slots
+
+
+def _sizes(allocation):
+    return [sum(end - start + 1 for start, end in ranges) for ranges in allocation]
+
+
+@pytest.mark.parametrize("shards", [1, 3, 7, 64])
+def test_even_allocation_covers_every_slot(shards):
+    allocation = allocate_slots(shards)
+    sizes = _sizes(allocation)
+    assert sum(sizes) == CLUSTER_SLOTS
+    assert max(sizes) - min(sizes) <= 1
+    assert allocation[0][0][0] == 0
+    assert allocation[-1][-1][1] == CLUSTER_SLOTS - 1
+
+
+def test_weighted_allocation():
+    sizes = _sizes(allocate_slots(3, weights=[1, 1, 2]))
+    assert sizes == [4096, 4096, 8192]
+    assert _sizes(allocate_slots(2, weights=[0, 1])) == [0, CLUSTER_SLOTS]
+
+
+def test_explicit_ranges():
+    allocation = allocate_slots(2, ranges=[[(0, 99), (200, 16383)], [(100, 199)]])
+    assert allocation == [[(0, 99), (200, 16383)], [(100, 199)]]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"weights": [1, 1]},
+        {"weights": [0, 0, 0]},
+        {"weights": [-1, 1, 1]},
+        {"ranges": [[(0, 16383)], [(0, 10)], []]},
+        {"ranges": [[(0, 100)], [(101, 200)], [(201, 16382)]]},
+    ],
+)
+def test_invalid_allocations(kwargs):
+    with pytest.raises(ValueError):
+        allocate_slots(3, **kwargs)
+
+
+@pytest.fixture
+def fake_binary(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "PORT_LEASE_FILE", str(tmp_path / "ports.lease"))
+    monkeypatch.setattr(utils, "_port_is_free", lambda port: True)
+    probe = {"version": 70200, "options": ["enable-debug-command", "io-threads"]}
+    monkeypatch.setattr(cluster, "probe_redis_binary", lambda *args, **kwargs: probe)
+
+
+def _cluster_env(tmp_path, **kwargs):
+    return ClusterEnv(
+        shardsCount=3,
+        useSlaves=True,
+        redisBinaryPath="redis-server",
+        remstate=str(tmp_path),
+        outputFilesFormat="%s-test",
+        modulePath=None,
+        moduleArgs=None,
+        password="secret",
+        **kwargs,
+    )
+
+
+def test_state_round_trip(tmp_path, fake_binary, monkeypatch):
+    probe = cluster.probe_redis_binary
+    env = _cluster_env(tmp_path, name="ci", bootstrap="star", slotWeights=[1, 1, 2])
+    env.shards[1].masterProcess = 4321
+    state = json.loads(json.dumps(env.toState()))
+
+    def no_probe(*args, **kwargs):
+        raise AssertionError("re-attaching must not probe the binary")
+
+    monkeypatch.setattr(cluster, "probe_redis_binary", no_probe)
+    attached = ClusterEnv.fromState(state)
+    assert json.loads(json.dumps(attached.toState())) == state
+    assert [shard.getMasterPort() for shard in attached.shards] == [
+        10000,
+        10002,
+        10004,
+    ]
+    assert attached.shards[0].slavePort == 10001
+    assert attached.slotRanges == env.slotRanges
+    assert attached.envIsUp and not attached.envIsHealthy
+    assert attached.shards[1].getPid(cluster.MASTER) == 4321
+
+    # a re-attached env can build the same command lines to start again
+    monkeypatch.setattr(cluster, "probe_redis_binary", probe)
+    for shard, original in zip(attached.shards, env.shards):
+        for role in (cluster.MASTER, cluster.SLAVE):
+            assert shard.getCmdArgs(role) == original.getCmdArgs(role)
+        assert shard.slaveOSEnv == original.slaveOSEnv
+
+
+def test_unsupported_profile_options_are_reported(tmp_path, fake_binary, capsys):
+    profile = {
+        "name": "tuned",
+        "settings": {"io-threads": "2", "lazyfree-lazy-eviction": "yes"},
+    }
+    env = _cluster_env(tmp_path, profile=profile)
+    env._warnSkippedProfileOptions()
+    assert "lazyfree-lazy-eviction is not supported" in capsys.readouterr().out
+    args = env.shards[0].getCmdArgs(cluster.MASTER)
+    assert "--lazyfree-lazy-eviction" not in args
+    assert args[args.index("--io-threads") + 1] == "2"
+
+    state = json.loads(json.dumps(env.toState()))
+    assert ClusterEnv.fromState(state).shards[0].appliedProfile == {
+        "settings": {"io-threads": "2"},
+        "skipped": ["lazyfree-lazy-eviction"],
+    }
+    lines = []
+    cluster_state.print_state(state, write=lines.append)
+    assert "\t\tio-threads 2" in lines
+    assert "\t\tlazyfree-lazy-eviction yes" not in lines
+    assert "\t\tnot supported, skipped: lazyfree-lazy-eviction" in lines
+
+
+def test_port_blocks():
+    assert cluster.port_blocks([10004, 10000, 10002], 2) == [(10000, 6)]
+    assert cluster.port_blocks([10000, 10001, 10005], 1) == [(10000, 2), (10005, 1)]
+
+
+def test_fixed_ports_are_leased(tmp_path, fake_binary):
+    ports = [12000, 12002, 12004]
+    env = _cluster_env(tmp_path, ports=ports)
+    assert env.portLease == env.uuid
+    with pytest.raises(Exception, match="in use"):
+        _cluster_env(tmp_path, ports=ports)
+    utils.release_ports(env.portLease)
+    assert _cluster_env(tmp_path, ports=ports).portLease
+
+
+def test_failed_port_reservation_is_rolled_back(tmp_path, fake_binary):
+    assert utils.reserve_ports(12004, 2, "held")
+    with pytest.raises(Exception, match="12004-12005"):
+        _cluster_env(tmp_path, ports=[11000, 12004, 15000])
+    assert utils.reserve_ports(11000, 2, "other")
+
+
+def test_default_ports_are_never_randomized(tmp_path, fake_binary):
+    assert utils.reserve_ports(10002, 1, "held")
+    with pytest.raises(Exception, match="10000-10005"):
+        _cluster_env(tmp_path)
+    env = _cluster_env(tmp_path, randomizePorts=True)
+    assert env.shards[0].getMasterPort() != 10000
+
+
+class FakeShard:
+    def __init__(self, port, knownNodes):
+        self.port = port
+        self.knownNodes = knownNodes
+        self.meets = []
+
+    def getMasterPort(self):
+        return self.port
+
+    def getConnection(self):
+        return self
+
+    def execute_command(self, *args):
+        if args[:2] == ("CLUSTER", "MEET"):
+            self.meets.append(args[3])
+            return "OK"
+        if args == ("CLUSTER", "INFO"):
+            # report the known node counts in turn, then stick to the last one
+            known = self.knownNodes[0]
+            if len(self.knownNodes) > 1:
+                self.knownNodes.pop(0)
+            return "cluster_state:fail\r\ncluster_known_nodes:%d\r\n" % known
+        raise AssertionError(args)
+
+
+def _fake_cluster(shards):
+    env = ClusterEnv.__new__(ClusterEnv)
+    env.shards = shards
+    return env
+
+
+def test_star_bootstrap_meets_through_the_seed():
+    shards = [FakeShard(10000 + 2 * n, [4]) for n in range(4)]
+    env = _fake_cluster(shards)
+    env._meetStar()
+    assert shards[0].meets == [10002, 10004, 10006]
+    assert all(not shard.meets for shard in shards[1:])
+
+
+def test_wait_convergence(monkeypatch):
+    monkeypatch.setattr(cluster.time, "sleep", lambda seconds: None)
+    env = _fake_cluster([FakeShard(10000, [1, 1, 2]), FakeShard(10002, [2])])
+    env.waitConvergence(timeout_sec=5)
+    assert env.convergenceTime is not None
+
+    env = _fake_cluster([FakeShard(10000, [2]), FakeShard(10002, [1])])
+    with pytest.raises(RuntimeError, match="1 of 2 nodes"):
+        env.waitConvergence(timeout_sec=0.05)
+
+
+# two NUMA nodes of four cores each, hyperthread siblings last
+TOPOLOGY = [[0, 1, 2, 3, 8, 9, 10, 11], [4, 5, 6, 7, 12, 13, 14, 15]]
+
+
+def test_core_placement_spreads_shards_over_nodes():
+    plan = cluster.plan_cpu_placement("core", 4, 2, topology=TOPOLOGY)
+    assert [shard["node"] for shard in plan] == [0, 1, 0, 1]
+    assert [shard["cpus"] for shard in plan] == [
+        [[0], [1]],
+        [[4], [5]],
+        [[2], [3]],
+        [[6], [7]],
+    ]
+
+
+def test_core_placement_shares_cores_once_a_node_is_full():
+    plan = cluster.plan_cpu_placement(
+        "core", 3, 2, cpusPerServer=3, topology=[[0, 1, 2, 3, 4, 5, 6, 7]]
+    )
+    cpus = [server for shard in plan for server in shard["cpus"]]
+    assert cpus[:2] == [[0, 1, 2], [3, 4, 5]]
+    assert cpus[2] == [0, 6, 7]
+    assert all(len(server) == 3 for server in cpus)
+
+
+def test_numa_placement_pins_shards_to_whole_nodes():
+    plan = cluster.plan_cpu_placement("numa", 3, 2, topology=TOPOLOGY)
+    assert [shard["node"] for shard in plan] == [0, 1, 0]
+    assert plan[1]["cpus"] == [TOPOLOGY[1], TOPOLOGY[1]]
+
+
+def test_no_placement():
+    assert cluster.plan_cpu_placement("none", 3, 1, topology=TOPOLOGY) is None
+    with pytest.raises(ValueError):
+        cluster.plan_cpu_placement("socket", 3, 1, topology=TOPOLOGY)
+
+
+def test_drop_ephemeral_dir_keeps_failed_logs(tmp_path, fake_binary):
+    ephemeralDir = tmp_path / "shm"
+    env = _cluster_env(tmp_path / "remstate", ephemeralDir=str(ephemeralDir))
+    for shard in env.shards:
+        shard._makeStateDirs()
+        for role in (cluster.MASTER, cluster.SLAVE):
+            with open(shard._getLogFilePath(role), "w") as f:
+                f.write("Ready to accept connections\n")
+        with open(shard._getRdbFilePath(cluster.MASTER), "wb") as f:
+            f.write(b"x" * 100)
+    failed = env.shards[1]
+    failed.failedRoles.add(cluster.SLAVE)
+    assert str(ephemeralDir) in failed._getLogFilePath(cluster.SLAVE)
+
+    stats = [{"rdbSaves": 3, "rdbSize": 100, "aofRewrites": 1, "aofBaseSize": 50}]
+    env._dropEphemeralDir(stats)
+    report = env.ephemeralReport
+    assert not ephemeralDir.exists()
+    assert report["rdbSaves"] == 3 and report["aofRewrites"] == 1
+    logBytes = 6 * len("Ready to accept connections\n")
+    assert report["bytesSaved"] == 3 * 100 + logBytes + 3 * 100 + 50
+    kept = tmp_path / "remstate" / "log" / os.path.basename(
+        failed._getLogFilePath(cluster.SLAVE)
+    )
+    assert report["keptLogs"] == [str(kept)]
+    assert kept.read_text() == "Ready to accept connections\n"
+
+
+def _fake_server_process(ignoreTerm=False):
+    code = "import signal, sys, time\n"
+    if ignoreTerm:
+        code += "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+    code += "print('ready', flush=True)\ntime.sleep(60)\n"
+    proc = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+    assert proc.stdout.readline() == b"ready\n"
+    return proc
+
+
+def _read_commands(sock):
+    """Yield the commands a redis client sends, as lists of bytes"""
+    buf = b""
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        buf += data
+        while True:
+            lines = buf.split(b"\r\n")
+            if not lines[0].startswith(b"*"):
+                break
+            argc = int(lines[0][1:])
+            if len(lines) < 2 + 2 * argc:
+                break
+            args = lines[2 : 2 + 2 * argc : 2]
+            buf = b"\r\n".join(lines[1 + 2 * argc :])
+            yield args
+
+
+def _fake_reply(args):
+    command = args[0].upper()
+    if command == b"HELLO":
+        return b"%%1\r\n+proto\r\n:%s\r\n" % args[1]
+    return b"+PONG\r\n" if command == b"PING" else b"+OK\r\n"
+
+
+@pytest.fixture
+def stop_env(tmp_path, monkeypatch):
+    terminated = []
+    terminate = psutil.Process.terminate
+
+    def record_terminate(process):
+        terminated.append(process.pid)
+        terminate(process)
+
+    monkeypatch.setattr(psutil.Process, "terminate", record_terminate)
+
+    def make(port):
+        env = cluster.StandardEnv(
+            "redis-server",
+            port=port,
+            remstate=str(tmp_path),
+            outputFilesFormat="%s-test",
+        )
+        env.terminated = terminated
+        return env
+
+    return make
+
+
+def _listener():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    return listener
+
+
+def test_nosave_stop_of_a_hung_server_falls_back_to_sigterm(stop_env, capsys):
+    listener = _listener()
+    proc = _fake_server_process()
+    env = stop_env(listener.getsockname()[1])
+    env.masterProcess = proc.pid
+    st = time.time()
+    env.stopEnv(timeout_sec=2, noSave=True)
+    listener.close()
+    assert time.time() - st < 2
+    assert env.terminated == [proc.pid]
+    assert env.masterExitCode == -signal.SIGTERM
+    assert env.masterProcess is None and not env.envIsUp
+    assert "did not take SHUTDOWN NOSAVE" in capsys.readouterr().out
+
+
+def test_nosave_stop_of_a_refused_connection_falls_back_to_sigterm(stop_env):
+    listener = _listener()
+    port = listener.getsockname()[1]
+    listener.close()
+    proc = _fake_server_process()
+    env = stop_env(port)
+    env.masterProcess = proc.pid
+    st = time.time()
+    env.stopEnv(timeout_sec=5, noSave=True)
+    assert time.time() - st < 2
+    assert env.terminated == [proc.pid]
+    assert env.masterExitCode == -signal.SIGTERM
+
+
+def test_nosave_stop_lets_the_server_exit_by_itself(stop_env):
+    listener = _listener()
+    proc = _fake_server_process()
+
+    def serve():
+        sock, _ = listener.accept()
+        with sock:
+            for args in _read_commands(sock):
+                if args[0].upper() == b"SHUTDOWN":
+                    # exit like a server taking SHUTDOWN NOSAVE, dropping the client
+                    proc.send_signal(signal.SIGUSR1)
+                    return
+                sock.sendall(_fake_reply(args))
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    env = stop_env(listener.getsockname()[1])
+    env.masterProcess = proc.pid
+    env.stopEnv(timeout_sec=5, noSave=True)
+    server.join(timeout=5)
+    listener.close()
+    assert env.terminated == []
+    assert env.masterExitCode == -signal.SIGUSR1
+
+
+def test_wait_for_stop_kills_servers_past_the_deadline(stop_env):
+    proc = _fake_server_process(ignoreTerm=True)
+    env = stop_env(10000)
+    env.masterProcess = proc.pid
+    st = time.time()
+    env.stopEnv(timeout_sec=0.5)
+    assert time.time() - st < 3
+    assert env.terminated == [proc.pid]
+    assert env.masterExitCode == -signal.SIGKILL
+    assert cluster.MASTER in env.failedRoles
+
+
+def test_invalid_cluster_takes_no_ports(tmp_path, fake_binary):
+    with pytest.raises(ValueError):
+        _cluster_env(tmp_path, port=13000, slotWeights=[1, 1])
+    assert _cluster_env(tmp_path, port=13000).portLease
+
+
+def test_failed_shard_setup_releases_ports_and_ephemeral_dir(
+    tmp_path, fake_binary, monkeypatch
+):
+    shm = tmp_path / "shm"
+    shm.mkdir()
+    monkeypatch.setattr(cluster, "ephemeral_root", lambda: str(shm))
+    with pytest.raises(ValueError, match="Unix sockets"):
+        _cluster_env(tmp_path, port=13000, ephemeral=True, unix=True)
+    assert not os.listdir(shm)
+    assert _cluster_env(tmp_path, port=13000).portLease
+
+
+def _starting_env(tmp_path):
+    env = cluster.StandardEnv(
+        "redis-server",
+        port=_unused_port(),
+        remstate=str(tmp_path),
+        outputFilesFormat="%s-test",
+    )
+    env._makeStateDirs()
+    return env
+
+
+def _unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _starting_server(code):
+    return subprocess.Popen(
+        [sys.executable, "-c", "import sys, time\n" + code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def test_startup_exit_prints_the_server_output(tmp_path, capsys):
+    env = _starting_env(tmp_path)
+    proc = _starting_server(
+        "print('*** FATAL CONFIG FILE ERROR ***'); print('Bad directive'); sys.exit(1)"
+    )
+    env.masterProcess = proc.pid
+    with pytest.raises(Exception, match="master-1 failed to start: exited"):
+        env.waitForRedisToStart(env.getConnection(), proc, cluster.MASTER)
+    out = capsys.readouterr().out
+    assert "exited during startup with code 1" in out
+    assert "Bad directive" in out
+    assert env.masterProcess is None and env.masterExitCode == 1
+    assert cluster.MASTER in env.failedRoles
+
+
+def test_startup_fatal_log_prints_the_bug_report(tmp_path, capsys):
+    env = _starting_env(tmp_path)
+    log = env._getLogFilePath(cluster.MASTER)
+    with open(log, "w") as f:
+        f.write("old run\n")
+    offset = os.path.getsize(log)
+    report = [
+        "=== REDIS BUG REPORT START: Cut & paste starting from here ===",
+        "crashed by signal: 11",
+        "------ INFO OUTPUT ------",
+        "redis_version:7.2.4",
+    ]
+    proc = _starting_server(
+        "with open(%r, 'a') as f:\n    f.write(%r)\nsys.exit(139)\n"
+        % (log, "".join(line + "\n" for line in report))
+    )
+    env.masterProcess = proc.pid
+    with pytest.raises(Exception, match="failed to start: fatal"):
+        env.waitForRedisToStart(env.getConnection(), proc, cluster.MASTER, offset)
+    out = capsys.readouterr().out
+    assert "logged a fatal error" in out
+    assert "crashed by signal: 11" in out
+    assert "redis_version" not in out and "old run" not in out
@@ -0,0 +1,41 @@
+import importlib.util
+import math
+import os
+
+import pytest
+
+LIFECYCLE_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, "benchmarks", "lifecycle.py"
+)
+
+
+@pytest.fixture(scope="module")
+def lifecycle():
+    spec = importlib.util.spec_from_file_location("lifecycle", LIFECYCLE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_betainc_known_values(lifecycle):
+    assert lifecycle._betainc(1.0, 1.0, 0.3) == pytest.approx(0.3)
+    assert lifecycle._betainc(2.5, 2.5, 0.5) == pytest.approx(0.5)
+    assert lifecycle._betainc(2.0, 3.0, 0.0) == 0.0
+    assert lifecycle._betainc(2.0, 3.0, 1.0) == 1.0
+
+
+def test_welch_test_flags_a_slower_run(lifecycle):
+    # equal variances and sizes: t = 4 over 8 degrees of freedom
+    t, df, p = lifecycle.welch_test([1, 2, 3, 4, 5], [5, 6, 7, 8, 9])
+    assert t == pytest.approx(4.0)
+    assert df == pytest.approx(8.0)
+    assert p == pytest.approx(0.00197, abs=1e-5)
+
+    t, df, p = lifecycle.welch_test([5, 6, 7, 8, 9], [1, 2, 3, 4, 5])
+    assert t == pytest.approx(-4.0)
+    assert p == pytest.approx(1 - 0.00197, abs=1e-5)
+
+
+def test_welch_test_without_variance(lifecycle):
+    assert lifecycle.welch_test([1, 1], [2, 2]) == (math.inf, 2, 0.0)
+    assert lifecycle.welch_test([2, 2], [1, 1]) == (0.0, 2, 1.0)
@@ -0,0 +1,352 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import threading
+import zipfile
+
+import pytest
+import requests
+import yaml
+
+from redisero import loader
+
+
+class ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    """Serves server.files with Range, If-Range and injected failures"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        body, etag = server.files[self.path]
+        start = 0
+        rng = self.headers.get("Range")
+        ifRange = self.headers.get("If-Range")
+        if rng and (ifRange is None or ifRange == etag):
+            start = int(rng.split("=")[1].rstrip("-"))
+        if start >= len(body) and start:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % len(body))
+            self.end_headers()
+            return
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if server.truncate:
+            # drop the connection half way through the body
+            server.truncate -= 1
+            self.wfile.write(body[start : start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArtifactHandler)
+    httpd.files = {}
+    httpd.requests = []
+    httpd.truncate = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:%d" % httpd.server_address[1]
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def module_loader(tmp_path, monkeypatch):
+    monkeypatch.setattr(loader.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(loader, "DOWNLOAD_CHUNK_SIZE", 4096)
+    return loader.ModuleLoader(
+        cfg_path=str(tmp_path / "cfg" / "modules.yml"), state_dir_path=str(tmp_path)
+    )
+
+
+def _part_path(url, path):
+    return "%s.%s.part" % (path, hashlib.sha256(url.encode()).hexdigest()[:16])
+
+
+def _download(module_loader, url, path, sha256=None):
+    with requests.Session() as session:
+        return module_loader._download(session, url, str(path), sha256)
+
+
+def test_download_verifies_checksum(server, module_loader, tmp_path):
+    body = os.urandom(100000)
+    server.files["/a.zip"] = (body, '"a1"')
+    path = tmp_path / "a.zip"
+    _download(
+        module_loader, server.url + "/a.zip", path, hashlib.sha256(body).hexdigest()
+    )
+    assert path.read_bytes() == body
+    assert not [name for name in os.listdir(tmp_path) if ".part" in name]
+
+
+def test_download_resumes_after_interruption(server, module_loader, tmp_path):
+    body = os.urandom(300000)
+    server.files["/a.zip"] = (body, '"a1"')
+    server.truncate = 1
+    path = tmp_path / "a.zip"
+    _download(
+        module_loader, server.url + "/a.zip", path, hashlib.sha256(body).hexdigest()
+    )
+    assert path.read_bytes() == body
+    resumed = server.requests[-1][1]
+    assert resumed["Range"].startswith("bytes=")
+    assert 0 < int(resumed["Range"][6:-1]) <= len(body) // 2
+    assert resumed["If-Range"] == '"a1"'
+
+
+def test_download_checksum_mismatch(server, module_loader, tmp_path, monkeypatch):
+    monkeypatch.setattr(loader, "DOWNLOAD_RETRIES", 2)
+    server.files["/a.zip"] = (b"corrupt", '"a1"')
+    path = tmp_path / "a.zip"
+    with pytest.raises(ValueError):
+        _download(module_loader, server.url + "/a.zip", path, "0" * 64)
+    assert len(server.requests) == 2
+    assert not path.exists()
+    assert not [name for name in os.listdir(tmp_path) if ".part" in name]
+
+
+def test_download_ignores_partial_file_of_other_url(
+    server, module_loader, tmp_path, monkeypatch
+):
+    old, new = os.urandom(200000), os.urandom(200000)
+    server.files["/v1.zip"] = (old, '"v1"')
+    server.files["/v2.zip"] = (new, '"v2"')
+    path = tmp_path / "a.zip"
+    server.truncate = 1
+    monkeypatch.setattr(loader, "DOWNLOAD_RETRIES", 1)
+    with pytest.raises(requests.RequestException):
+        _download(module_loader, server.url + "/v1.zip", path)
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+    _download(module_loader, server.url + "/v2.zip", path)
+    assert path.read_bytes() == new
+    assert "Range" not in server.requests[-1][1]
+    assert not [name for name in os.listdir(tmp_path) if ".part" in name]
+
+
+def test_download_restarts_when_artifact_changed(
+    server, module_loader, tmp_path, monkeypatch
+):
+    old, new = os.urandom(200000), os.urandom(200000)
+    server.files["/a.zip"] = (old, '"v1"')
+    path = tmp_path / "a.zip"
+    server.truncate = 1
+    monkeypatch.setattr(loader, "DOWNLOAD_RETRIES", 1)
+    with pytest.raises(requests.RequestException):
+        _download(module_loader, server.url + "/a.zip", path)
+
+    server.files["/a.zip"] = (new, '"v2"')
+    _download(module_loader, server.url + "/a.zip", path)
+    assert path.read_bytes() == new
+    assert server.requests[-1][1]["If-Range"] == '"v1"'
+
+
+def test_download_keeps_complete_partial_file(server, module_loader, tmp_path):
+    body = os.urandom(50000)
+    server.files["/a.zip"] = (body, '"a1"')
+    path = tmp_path / "a.zip"
+    url = server.url + "/a.zip"
+    with open(_part_path(url, path), "wb") as f:
+        f.write(body)
+    _download(module_loader, url, path)
+    assert path.read_bytes() == body
+    assert len(server.requests) == 1
+
+
+def test_download_discards_oversized_partial_file(server, module_loader, tmp_path):
+    body = os.urandom(50000)
+    server.files["/a.zip"] = (body, '"a1"')
+    path = tmp_path / "a.zip"
+    url = server.url + "/a.zip"
+    with open(_part_path(url, path), "wb") as f:
+        f.write(os.urandom(len(body) + 10))
+    _download(module_loader, url, path)
+    assert path.read_bytes() == body
+    assert "Range" not in server.requests[-1][1]
+    assert not [name for name in os.listdir(tmp_path) if ".part" in name]
+
+
+def test_download_all_uses_a_session_per_worker(module_loader, monkeypatch):
+    used = set()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def download(session, url, path, sha256=None):
+        # hold both workers until each has picked its session
+        barrier.wait()
+        used.add((threading.get_ident(), session))
+        return path
+
+    monkeypatch.setattr(module_loader, "_download", download)
+    module_loader.download_workers = 2
+    targets = [
+        (loader.Module(name=name, platform="ubuntu22.04"), {"path": name})
+        for name in ("a", "b", "c", "d")
+    ]
+    assert len(module_loader._download_all(targets)) == 4
+    threads = {thread for thread, _ in used}
+    sessions = {session for _, session in used}
+    assert len(threads) == len(sessions) == 2
+
+
+PLATFORM = "ubuntu22.04-x86_64"
+
+
+def _module_zip(content, module_file="module.so"):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        archive.writestr(loader.MODULE_METADATA_FILE, json.dumps({"module_file": module_file}))
+        archive.writestr(module_file, content)
+    return buf.getvalue()
+
+
+def _configured_loader(tmp_path, modules):
+    cfg_path = tmp_path / "cfg" / "modules.yml"
+    cfg_path.parent.mkdir(exist_ok=True)
+    cfg_path.write_text(yaml.safe_dump(modules))
+    return loader.ModuleLoader(cfg_path=str(cfg_path), state_dir_path=str(tmp_path))
+
+
+@pytest.fixture
+def search_module(server, monkeypatch):
+    """A search module served by the test server, resolved without npm"""
+    server.files["/search.zip"] = (_module_zip(b"search-so"), '"s1"')
+    resolved = []
+
+    def resolve_target(self, module):
+        resolved.append(module.name)
+        return {"path": server.url + "/search.zip"}
+
+    monkeypatch.setattr(loader.ModuleLoader, "_resolve_target", resolve_target)
+    monkeypatch.setattr(
+        loader.ModuleLoader, "download_module_packages", lambda self, modules=None: None
+    )
+    return resolved
+
+
+def test_install_skips_current_modules(server, search_module, tmp_path):
+    config = [{"name": "search", "version": "2.8.4", "platform": PLATFORM}]
+    _configured_loader(tmp_path, config).install()
+    assert len(server.requests) == 1
+
+    ml = _configured_loader(tmp_path, config)
+    ml.install()
+    assert ml.is_current()
+    assert len(server.requests) == 1
+
+
+@pytest.mark.parametrize(
+    "change", [{"version": "2.8.5"}, {"platform": "rhel8-x86_64"}]
+)
+def test_version_or_platform_change_is_not_current(
+    server, search_module, tmp_path, change
+):
+    config = {"name": "search", "version": "2.8.4", "platform": PLATFORM}
+    _configured_loader(tmp_path, [config]).install()
+
+    ml = _configured_loader(tmp_path, [dict(config, **change)])
+    ml.load_config()
+    assert not ml.is_current()
+
+
+def test_removed_module_file_is_not_current(server, search_module, tmp_path):
+    config = [{"name": "search", "version": "2.8.4", "platform": PLATFORM}]
+    ml = _configured_loader(tmp_path, config)
+    ml.install()
+    os.remove(ml.manifest[loader.module_key(ml.modules[0])]["path"])
+
+    ml = _configured_loader(tmp_path, config)
+    ml.load_config()
+    assert not ml.is_current()
+    ml.install()
+    assert ml.is_current()
+    assert len(server.requests) == 2
+
+
+def test_lock_pins_resolved_artifacts(server, search_module, tmp_path):
+    config = [{"name": "search", "version": "2.8.4", "platform": PLATFORM}]
+    _configured_loader(tmp_path, config).install()
+    assert search_module == ["search"]
+    with open(tmp_path / "cfg" / loader.LOCK_FILE) as f:
+        lock = json.load(f)
+    pinned = lock["modules"]["search@2.8.4/" + PLATFORM.lower()]
+    assert pinned["url"] == server.url + "/search.zip"
+    assert pinned["sha256"] == hashlib.sha256(server.files["/search.zip"][0]).hexdigest()
+
+    # a forced reinstall downloads the pinned artifact without resolving it
+    _configured_loader(tmp_path, config).install(force=True)
+    assert search_module == ["search"]
+    assert len(server.requests) == 2
+
+    _configured_loader(tmp_path, config).install(update=True)
+    assert search_module == ["search", "search"]
+
+
+def test_lock_rejects_changed_artifact(server, search_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(loader, "DOWNLOAD_RETRIES", 1)
+    config = [{"name": "search", "version": "2.8.4", "platform": PLATFORM}]
+    _configured_loader(tmp_path, config).install()
+
+    server.files["/search.zip"] = (_module_zip(b"tampered-so"), '"s2"')
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        _configured_loader(tmp_path, config).install(force=True)
+
+
+def test_load_lists_follow_the_config(server, search_module, tmp_path):
+    config = {"name": "search", "version": "2.8.4", "platform": PLATFORM}
+    _configured_loader(tmp_path, [config]).install()
+
+    ml = _configured_loader(tmp_path, [config])
+    paths, args = ml.load_list(PLATFORM)
+    assert [os.path.basename(path) for path in paths] == ["module.so"]
+    assert args is None
+    assert ml.load_list("rhel8-x86_64") == ([], None)
+
+    # new args take effect on the next install without downloading again
+    ml = _configured_loader(tmp_path, [dict(config, args="MAXDOCS 10;TIMEOUT 0")])
+    ml.install()
+    assert len(server.requests) == 1
+    fresh = _configured_loader(tmp_path, [config])
+    assert fresh.load_list(PLATFORM) == (paths, [["MAXDOCS 10", "TIMEOUT 0"]])
+
+
+def test_manifest_of_unknown_version_is_ignored(server, search_module, tmp_path):
+    config = [{"name": "search", "version": "2.8.4", "platform": PLATFORM}]
+    ml = _configured_loader(tmp_path, config)
+    ml.install()
+    with open(ml.manifest_path) as f:
+        manifest = json.load(f)
+    manifest["version"] = loader.MANIFEST_VERSION + 1
+    with open(ml.manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+    ml = _configured_loader(tmp_path, config)
+    assert ml.load_list(PLATFORM) == ([], None)
+    ml.load_config()
+    assert not ml.is_current()
+
+
+def test_identical_module_files_are_hard_linked(server, search_module, tmp_path):
+    config = [
+        {"name": "search", "version": "2.8.4", "platform": PLATFORM},
+        {"name": "search", "version": "2.8.4", "platform": "rhel8-x86_64"},
+    ]
+    ml = _configured_loader(tmp_path, config)
+    ml.install()
+    paths = [ml.manifest[loader.module_key(module)]["path"] for module in ml.modules]
+    assert paths[0] != paths[1]
+    assert os.path.samefile(*paths)
+    for path in paths:
+        assert os.stat(path).st_mode & 0o777 == 0o777
+        with open(path, "rb") as f:
+            assert f.read() == b"search-so"
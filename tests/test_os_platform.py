@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from redisero import os_platform
+
+
+@pytest.fixture
+def detections(tmp_path, monkeypatch):
+    """Count real platform detections, reading a fake os-release"""
+    os_release = tmp_path / "os-release"
+    os_release.write_text('ID=ubuntu\nVERSION_ID="22.04"\n')
+    monkeypatch.setattr(os_platform, "PLATFORM_RELEASE_FILES", [str(os_release)])
+    monkeypatch.setattr(os_platform, "_current_platform", None)
+    detected = []
+
+    def detect(self, strict=False, brand=False):
+        detected.append(os_release.read_text())
+        self.os, self.osnick, self.arch = "linux", "jammy", "x64"
+
+    monkeypatch.setattr(os_platform.Platform, "__init__", detect)
+    return detected
+
+
+def _forget_current_platform(monkeypatch):
+    monkeypatch.setattr(os_platform, "_current_platform", None)
+
+
+def test_current_platform_is_memoized(detections):
+    plat = os_platform.current_platform()
+    assert os_platform.current_platform() is plat
+    assert plat.triplet() == "linux-jammy-x64"
+    assert len(detections) == 1
+
+
+def test_current_platform_loads_the_cache(detections, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    os_platform.current_platform(cache_dir)
+    assert os.path.exists(os.path.join(cache_dir, os_platform.PLATFORM_CACHE_FILE))
+
+    _forget_current_platform(monkeypatch)
+    plat = os_platform.current_platform(cache_dir)
+    assert isinstance(plat, os_platform.Platform)
+    assert plat.triplet() == "linux-jammy-x64"
+    assert len(detections) == 1
+
+
+def test_os_release_change_invalidates_the_cache(detections, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    os_platform.current_platform(cache_dir)
+
+    # an upgrade rewrites os-release, its size and mtime change
+    os_release = tmp_path / "os-release"
+    os_release.write_text('ID=ubuntu\nVERSION_ID="24.04"\n')
+    os.utime(os_release, ns=(0, 0))
+    _forget_current_platform(monkeypatch)
+    os_platform.current_platform(cache_dir)
+    assert len(detections) == 2
+    assert "24.04" in detections[-1]
+
+    # the refreshed cache is used again
+    _forget_current_platform(monkeypatch)
+    os_platform.current_platform(cache_dir)
+    assert len(detections) == 2
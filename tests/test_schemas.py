@@ -0,0 +1,60 @@
+import pytest
+
+from redisero import schemas
+
+
+def _profiles(tmp_path, text):
+    (tmp_path / schemas.PROFILES_FILE).write_text(text)
+    return str(tmp_path)
+
+
+def test_builtin_profile():
+    profile = schemas.load_profile("durable")
+    assert profile["name"] == "durable"
+    assert profile["settings"]["appendfsync"] == "always"
+
+
+def test_extends_resolution(tmp_path):
+    cfgDir = _profiles(
+        tmp_path,
+        "fast:\n"
+        "  extends: throughput\n"
+        "  hz: 50\n"
+        "  activedefrag: true\n"
+        "fastest:\n"
+        "  extends: fast\n"
+        "  io-threads: 8\n"
+        "  save: null\n",
+    )
+    profile = schemas.load_profile("fastest", cfgDir)
+    assert profile["name"] == "fastest"
+    settings = profile["settings"]
+    assert settings["io-threads"] == "8"
+    assert settings["hz"] == "50"
+    assert settings["activedefrag"] == "yes"
+    assert settings["save"] == ""
+    assert settings["tcp-backlog"] == schemas.PROFILES["throughput"]["tcp-backlog"]
+    assert "extends" not in settings
+
+
+def test_user_profile_overrides_builtin(tmp_path):
+    cfgDir = _profiles(tmp_path, "latency:\n  hz: 500\n")
+    assert schemas.load_profile("latency", cfgDir)["settings"] == {"hz": "500"}
+
+
+@pytest.mark.parametrize(
+    "name, text",
+    [
+        ("missing", ""),
+        ("child", "child:\n  extends: missing\n"),
+    ],
+)
+def test_unknown_profile(tmp_path, name, text):
+    with pytest.raises(ValueError, match="Unknown profile: missing"):
+        schemas.load_profile(name, _profiles(tmp_path, text))
+
+
+@pytest.mark.parametrize("text", ["- a\n- b\n", "a: [\n"])
+def test_invalid_profiles_file(tmp_path, text):
+    with pytest.raises(ValueError, match="Invalid"):
+        schemas.load_profile("throughput", _profiles(tmp_path, text))
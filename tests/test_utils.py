@@ -0,0 +1,214 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import redis
+
+from redisero import utils
+
+
+@pytest.fixture
+def lease_file(tmp_path, monkeypatch):
+    path = tmp_path / "ports.lease"
+    monkeypatch.setattr(utils, "PORT_LEASE_FILE", str(path))
+    monkeypatch.setattr(utils, "_port_is_free", lambda port: True)
+    return path
+
+
+def test_read_leases_skips_malformed_lines(lease_file):
+    lease_file.write_text("a 10000 4 1,2\nbroken line\nb 12000 2 3\n")
+    with open(lease_file) as fp:
+        assert utils._read_leases(fp) == [["a", 10000, 4, [1, 2]], ["b", 12000, 2, [3]]]
+
+
+def test_leases_of_dead_processes_are_dropped(lease_file):
+    dead = 2**22 + 1
+    lease_file.write_text("gone 10000 4 %d\n" % dead)
+    assert utils.reserve_ports(10000, 4, "mine")
+    assert lease_file.read_text() == "mine 10000 4 %d\n" % os.getpid()
+
+
+def test_fixed_and_random_leases_never_overlap(lease_file, monkeypatch):
+    monkeypatch.setattr(utils, "PORT_RANGE", (10000, 10009))
+    assert utils.reserve_ports(10000, 6, "fixed")
+    assert not utils.reserve_ports(10004, 2, "other")
+    assert utils.lease_ports(4, "random") == [10006, 10007, 10008, 10009]
+    with pytest.raises(Exception):
+        utils.lease_ports(1, "full")
+
+    utils.release_ports("fixed")
+    assert utils.reserve_ports(10004, 2, "other")
+
+
+@pytest.fixture
+def probes(tmp_path, monkeypatch):
+    calls = []
+
+    def run_probe(path):
+        calls.append(path)
+        return {
+            "probeVersion": utils.BINARY_PROBE_VERSION,
+            "path": path,
+            "version": 70200,
+            "options": ["appendfsync", "io-threads"],
+        }
+
+    monkeypatch.setattr(utils, "_run_binary_probe", run_probe)
+    monkeypatch.setattr(utils, "_binary_probes", {})
+    return calls
+
+
+def test_binary_probe_is_cached_by_path_mtime_and_size(tmp_path, probes):
+    binary = tmp_path / "redis-server"
+    binary.write_bytes(b"v1")
+    cacheDir = str(tmp_path / "bin")
+    probe = utils.probe_redis_binary(str(binary), cacheDir)
+    assert utils.probe_redis_binary(str(binary), cacheDir) is probe
+    assert len(probes) == 1
+
+    # a new process reads the persisted probe instead of forking the binary
+    utils._binary_probes.clear()
+    assert utils.probe_redis_binary(str(binary), cacheDir) == probe
+    assert len(probes) == 1
+
+    binary.write_bytes(b"rebuilt")
+    utils.probe_redis_binary(str(binary), cacheDir)
+    assert len(probes) == 2
+    with open(tmp_path / "bin" / utils.BINARY_PROBE_FILE) as f:
+        assert len(json.load(f)) == 1
+
+
+def test_outdated_cached_probes_are_redone(tmp_path, probes):
+    binary = tmp_path / "redis-server"
+    binary.write_bytes(b"v1")
+    st = os.stat(binary)
+    key = "%s:%d:%d" % (os.path.realpath(binary), st.st_mtime_ns, st.st_size)
+    (tmp_path / utils.BINARY_PROBE_FILE).write_text(
+        json.dumps({key: {"path": str(binary), "version": 70200, "options": []}})
+    )
+    probe = utils.probe_redis_binary(str(binary), str(tmp_path))
+    assert probes and probe["options"] == ["appendfsync", "io-threads"]
+
+
+def test_binary_supports_only_probed_options():
+    probe = {"version": 70200, "options": ["io-threads"]}
+    assert utils.binary_supports(probe, "io-threads")
+    assert not utils.binary_supports(probe, "no-such-option")
+
+
+def test_index_node_modules(tmp_path):
+    node_modules = tmp_path / "node_modules"
+    for package in ("redisearch", "@redis/json", "@redis/bloom", ".bin"):
+        (node_modules / package).mkdir(parents=True)
+    (node_modules / ".package-lock.json").write_text("{}")
+    packages, mtimes = utils.index_node_modules(str(node_modules))
+    assert packages == {
+        "redisearch": str(node_modules / "redisearch"),
+        "@redis/json": str(node_modules / "@redis" / "json"),
+        "@redis/bloom": str(node_modules / "@redis" / "bloom"),
+    }
+    assert sorted(mtimes) == [str(node_modules), str(node_modules / "@redis")]
+    assert utils.index_node_modules(str(tmp_path / "missing")) == ({}, {})
+
+
+def test_mtimes_changed(tmp_path):
+    node_modules = tmp_path / "node_modules"
+    (node_modules / "@redis").mkdir(parents=True)
+    _, mtimes = utils.index_node_modules(str(node_modules))
+    assert not utils.mtimes_changed(mtimes)
+    assert utils.mtimes_changed({})
+
+    # a package added to a scope only touches the scope folder
+    (node_modules / "@redis" / "json").mkdir()
+    os.utime(node_modules / "@redis", ns=(0, 0))
+    assert utils.mtimes_changed(mtimes)
+
+    _, mtimes = utils.index_node_modules(str(node_modules))
+    (node_modules / "@redis" / "json").rmdir()
+    (node_modules / "@redis").rmdir()
+    assert utils.mtimes_changed(mtimes)
+
+
+def _child(code):
+    """A fake redis-server child running the given python code"""
+    return subprocess.Popen(
+        [sys.executable, "-c", "import sys, time\n" + code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def _unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def children():
+    procs = []
+    yield procs
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+
+def _log_writer(path, *lines, exit_code=None):
+    code = "with open(%r, 'a') as f:\n" % str(path)
+    for line in lines:
+        code += "    f.write(%r); f.flush(); time.sleep(0.05)\n" % (line + "\n")
+    code += "sys.exit(%d)\n" % exit_code if exit_code is not None else "time.sleep(60)\n"
+    return code
+
+
+@pytest.mark.parametrize(
+    "line, status",
+    [
+        ("* Ready to accept connections tcp", "ready"),
+        ("# FATAL CONFIG FILE ERROR (Redis 7.2.4)", "fatal"),
+        ("=== REDIS BUG REPORT START: Cut & paste starting from here ===", "fatal"),
+    ],
+)
+def test_wait_for_server_reads_the_log(tmp_path, children, line, status):
+    log = tmp_path / "server.log"
+    log.write_text("* Ready to accept connections from an earlier run\n")
+    offset = log.stat().st_size
+    children.append(_child(_log_writer(log, "* Server initialized", line)))
+    conn = redis.Redis(port=_unused_port())
+    result, lines = utils.wait_for_server(children[0], conn, str(log), offset, timeout=5)
+    assert result == status
+    assert lines == ["* Server initialized", line]
+
+
+def test_wait_for_server_notices_an_early_exit(tmp_path, children):
+    children.append(_child("print('bad directive'); sys.exit(1)"))
+    conn = redis.Redis(port=_unused_port())
+    st = time.time()
+    status, _ = utils.wait_for_server(
+        children[0], conn, str(tmp_path / "never.log"), timeout=5
+    )
+    assert status == "exited"
+    assert time.time() - st < 5
+
+
+def test_wait_for_server_times_out(tmp_path, children):
+    log = tmp_path / "server.log"
+    children.append(_child(_log_writer(log, "* Loading RDB")))
+    conn = redis.Redis(port=_unused_port())
+    status, lines = utils.wait_for_server(children[0], conn, str(log), timeout=0.5)
+    assert (status, lines) == ("timeout", ["* Loading RDB"])
+
+
+def test_wait_for_server_probes_the_socket_without_log(children):
+    children.append(_child("time.sleep(60)"))
+    port = _unused_port()
+    conn = redis.Redis(port=port)
+    assert utils.wait_for_server(children[0], conn, timeout=0.3)[0] == "timeout"
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", port))
+        listener.listen(1)
+        assert utils.wait_for_server(children[0], conn, timeout=5) == ("ready", [])